@@ -0,0 +1,122 @@
+"""
+Benchmark model startup from `.pt` checkpoints against converted ones (container/checkpoints.py).
+
+Converts a model (by default a randomly initialised stand-in ESM-1v model of
+the given size) to each --dtypes, then loads every version in a fresh process
+and reports the time to load and prepare the model, the time of a first
+forward pass (which faults in the pages of a memory-mapped checkpoint), and
+the resident and anonymous memory of the process afterwards. Anonymous memory
+is what each process holds on its own; the pages of a memory-mapped
+checkpoint are file-backed and shared by all processes on a node that load it.
+Loads are repeated and the fastest kept, i.e. with the file in the page cache,
+as for consecutive jobs on a node.
+"""
+
+from argparse import SUPPRESS, ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer
+import json
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+from common import load_script, make_standin_esm1v
+
+
+def memory_mb():
+    """Resident and anonymous memory of this process, in MB"""
+
+    fields = {}
+    with open('/proc/self/smaps_rollup', 'rt') as in_handle:
+        for line in in_handle:
+            name, _, value = line.partition(':')
+            if value.strip().endswith('kB'):
+                fields[name] = int(value.split()[0]) / 1024
+    return {'rss_mb': fields['Rss'], 'anonymous_mb': fields['Anonymous']}
+
+
+def load(model_location, threads):
+    """Load a model as predict_substitutions.py does and run one short sequence through it"""
+
+    import torch
+    checkpoints = load_script('container/checkpoints.py')
+    inference = load_script('container/inference.py')
+    runtime = inference.Runtime('cpu', threads)
+
+    start_time = default_timer()
+    model, alphabet = checkpoints.load_model_and_alphabet(model_location)
+    model = runtime.prepare(model)
+    load_seconds = default_timer() - start_time
+
+    _, _, tokens = alphabet.get_batch_converter()([('protein', 'M' * 100)])
+    start_time = default_timer()
+    with torch.no_grad():
+        model(tokens)
+    forward_seconds = default_timer() - start_time
+
+    return {'load_seconds': load_seconds, 'first_forward_seconds': forward_seconds, **memory_mb()}
+
+
+def measure(model_location, threads, repeat):
+    """Fastest of repeat loads of a model, each in a fresh process"""
+
+    env = dict(os.environ)
+    # ESM checkpoints pickle their arguments, which recent PyTorch only loads with this
+    env.setdefault('TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD', '1')
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, __file__, '--load', str(model_location), '--threads', str(threads)],
+            check=True, capture_output=True, text=True, env=env
+        ).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+    return min(results, key=lambda result: result['load_seconds'])
+
+
+def main(args):
+    if args.load:
+        print(json.dumps(load(args.load, args.threads)))
+        return
+
+    checkpoints = load_script('container/checkpoints.py')
+    with TemporaryDirectory() as directory:
+        directory = Path(directory)
+        model_location = args.model_location
+        if model_location is None:
+            model_location = directory / 'esm1v_standin_1.pt'
+            make_standin_esm1v(model_location, args.seed, args.layers, args.dim, args.heads)
+        model_location = Path(model_location)
+
+        rows = [{'checkpoint': model_location.name, 'MB': model_location.stat().st_size / 2**20, **measure(
+            model_location, args.threads, args.repeat
+        )}]
+        model, alphabet = checkpoints.load_model_and_alphabet(str(model_location))
+        for dtype in args.dtypes:
+            path = directory / dtype / f'{model_location.stem}{checkpoints.CHECKPOINT_SUFFIX}'
+            path.parent.mkdir()
+            checkpoints.save_checkpoint(model, alphabet, path, checkpoints.DTYPES[dtype])
+            rows.append({'checkpoint': f'{path.name} ({dtype})', 'MB': path.stat().st_size / 2**20, **measure(
+                path, args.threads, args.repeat
+            )})
+
+    table = pd.DataFrame(rows)
+    table['speedup'] = table['load_seconds'].iloc[0] / table['load_seconds']
+    print(table.to_string(index=False, float_format='{:.3g}'.format))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Benchmark model loading from .pt and converted checkpoints')
+    parser.add_argument('--model-location', type=str, help='A .pt checkpoint; defaults to a stand-in ESM-1v model')
+    parser.add_argument('--layers', type=int, default=12, help='Layers of the stand-in model')
+    parser.add_argument('--dim', type=int, default=768, help='Embedding dimension of the stand-in model')
+    parser.add_argument('--heads', type=int, default=12, help='Attention heads of the stand-in model')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['float32', 'float16'])
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    # Internal: load this checkpoint in this process and print the measurements as JSON (see measure)
+    parser.add_argument('--load', type=str, help=SUPPRESS)
+    main(parser.parse_args())
@@ -0,0 +1,330 @@
+"""
+End-to-end CPU benchmark of the prediction and processing scripts, with stand-in models.
+
+Builds tiny randomly initialised ESM-1v and MSA Transformer checkpoints with the
+real ESM alphabet (see make_standin_esm1v in common.py), which the scripts load
+with esm.pretrained.load_model_and_alphabet like the real ones, and a synthetic
+proteome whose lengths follow the human proteome (log-normal around a median of
+about 415 AAs), with some proteins over 1022 AAs so that they are windowed.
+Then runs each stage as its own process and reports its wall time, throughput
+and peak resident memory:
+
+* predict_substitutions.py, masked-marginals and wt-marginals, over the proteome
+* process-results.py, over the masked-marginals output
+* predict.py, wt-marginals, masked-marginals and pseudo-ppl on a synthetic deep
+  mutational scan, and masked-marginals with the MSA Transformer
+
+Outputs are compared with golden files, so that a change can be checked for
+score equivalence as well as speed: run with --update-golden on the reference
+version of the code, then without it on the changed version. Rows are matched
+regardless of order, and scores within --rtol/--atol count as equal.
+
+python pipeline.py --work-dir /tmp/esm-bench --update-golden
+python pipeline.py --work-dir /tmp/esm-bench
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from timeit import default_timer
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+from common import (
+    AMINO_ACIDS, MAX_SEQ_LENTH, REPO_DIR, make_standin_esm1v, make_standin_msa_transformer, random_sequence
+)
+
+# Log-normal fit of human protein lengths
+LENGTH_MEDIAN = 415
+LENGTH_SIGMA = 0.65
+
+
+def synthetic_proteome(count: int, long_count: int, rng: np.random.Generator):
+    """(ID, sequence) of count proteins, at least long_count of which are over MAX_SEQ_LENTH"""
+
+    lengths = np.clip(rng.lognormal(np.log(LENGTH_MEDIAN), LENGTH_SIGMA, size=count), 30, 5000).astype(int)
+    short = np.flatnonzero(lengths <= MAX_SEQ_LENTH)
+    for index in short[:max(0, long_count - (count - short.size))]:
+        lengths[index] = rng.integers(MAX_SEQ_LENTH + 1, 2 * MAX_SEQ_LENTH)
+    return [(f'SYNTH{i:04d}', 'M' + random_sequence(length - 1, rng)) for i, length in enumerate(lengths)]
+
+
+def synthetic_dms(sequence: str, count: int, rng: np.random.Generator):
+    """Deep mutational scan of count single (and some double) mutants, with 1-based positions"""
+
+    mutants = set()
+    while len(mutants) < count:
+        mutations = []
+        for pos in sorted(rng.choice(len(sequence), size=1 if rng.random() < 0.8 else 2, replace=False)):
+            alt = rng.choice([aa for aa in AMINO_ACIDS if aa != sequence[pos]])
+            mutations.append(f'{sequence[pos]}{pos + 1}{alt}')
+        mutants.add(':'.join(mutations))
+    return pd.DataFrame({'mutant': sorted(mutants), 'score': rng.normal(size=count)})
+
+
+def synthetic_msa(sequence: str, depth: int, rng: np.random.Generator):
+    """a3m of the query and depth - 1 homologs with substitutions, deletions and insertions"""
+
+    lines = [f'>query\n{sequence}']
+    for i in range(1, depth):
+        identity = rng.uniform(0.3, 0.9)
+        row = []
+        for aa in sequence:
+            draw = rng.random()
+            if draw > identity + (1 - identity) * 0.8:
+                row.append('-')
+            elif draw > identity:
+                row.append(rng.choice(list(AMINO_ACIDS)))
+            else:
+                row.append(aa)
+            if rng.random() < 0.01:
+                row.append(random_sequence(rng.integers(1, 4), rng).lower())
+        lines.append(f'>homolog{i}\n{"".join(row)}')
+    return '\n'.join(lines) + '\n'
+
+
+def prepare_inputs(work_dir: Path, args):
+    """Write stand-in models and synthetic inputs, returning a dictionary of their paths and sizes"""
+
+    rng = np.random.default_rng(args.seed)
+    inputs = {}
+
+    model_dir = work_dir / 'models'
+    model_dir.mkdir(parents=True, exist_ok=True)
+    # Relative to the work directory, which stages run in, as predict.py names its output columns by model path
+    inputs['models'] = [Path('models') / f'esm1v_standin_{i}.pt' for i in range(1, args.models + 1)]
+    for i, path in enumerate(inputs['models'], start=1):
+        make_standin_esm1v(work_dir / path, i, args.layers, args.dim, args.heads)
+    inputs['msa_model'] = Path('models') / 'esm_msa_standin.pt'
+    make_standin_msa_transformer(work_dir / inputs['msa_model'], 0, args.layers, args.dim, args.heads)
+
+    proteome = synthetic_proteome(args.proteins, args.long_proteins, rng)
+    inputs['sequences'] = work_dir / 'proteome.fasta'
+    inputs['sequences'].write_text(''.join(f'>{seq_id}\n{sequence}\n' for seq_id, sequence in proteome))
+    inputs['positions'] = sum(len(sequence) for _, sequence in proteome)
+    inputs['long_proteins'] = sum(len(sequence) > MAX_SEQ_LENTH for _, sequence in proteome)
+
+    inputs['dms_sequence'] = random_sequence(args.dms_length, rng)
+    inputs['dms'] = work_dir / 'dms.csv'
+    synthetic_dms(inputs['dms_sequence'], args.dms_mutants, rng).to_csv(inputs['dms'], index=False)
+    inputs['msa'] = work_dir / 'msa.a3m'
+    inputs['msa'].write_text(synthetic_msa(inputs['dms_sequence'], args.msa_depth, rng))
+
+    return inputs
+
+
+def stages(inputs, output_dir: Path, args):
+    """(name, commands, outputs, work units, unit name) of each stage"""
+
+    python = sys.executable
+    predict_substitutions = str(REPO_DIR / 'container' / 'predict_substitutions.py')
+    predict = str(REPO_DIR / 'container' / 'predict.py')
+    device = ['--device', 'cpu', '--threads', str(args.threads)]
+    models = [str(path) for path in inputs['models']]
+
+    for strategy in ['masked-marginals', 'wt-marginals']:
+        results = output_dir / f'substitutions-{strategy}.csv'
+        yield (
+            f'predict_substitutions {strategy}',
+            [[
+                python, predict_substitutions, '--model-location', *models, '--sequences', str(inputs['sequences']),
+                '--results', str(results), '--scoring-strategy', strategy, *device
+            ]],
+            [results],
+            inputs['positions'] * len(models),
+            'positions'
+        )
+
+    processed = output_dir / 'processed'
+    yield (
+        'process-results',
+        [[
+            python, str(REPO_DIR / 'process-results.py'), '--source', str(output_dir / 'substitutions-masked-marginals.csv'),
+            '--output-dir', str(processed), '--overwrite'
+        ]],
+        [processed],
+        inputs['positions'],
+        'positions'
+    )
+
+    dms = ['--sequence', inputs['dms_sequence'], '--dms-input', str(inputs['dms']), '--offset-idx', '1']
+    for strategy in ['wt-marginals', 'masked-marginals', 'pseudo-ppl']:
+        dms_output = output_dir / f'dms-{strategy}.csv'
+        yield (
+            f'predict {strategy}',
+            [[
+                python, predict, '--model-location', *models, *dms, '--dms-output', str(dms_output),
+                '--scoring-strategy', strategy, *device
+            ]],
+            [dms_output],
+            args.dms_mutants * len(models),
+            'variants'
+        )
+
+    dms_output = output_dir / 'dms-msa-masked-marginals.csv'
+    yield (
+        'predict MSA Transformer masked-marginals',
+        [[
+            python, predict, '--model-location', str(inputs['msa_model']), *dms, '--dms-output', str(dms_output),
+            '--scoring-strategy', 'masked-marginals', '--msa-path', str(inputs['msa']),
+            '--msa-samples', str(args.msa_depth), *device
+        ]],
+        [dms_output],
+        args.dms_mutants,
+        'variants'
+    )
+
+
+def run_stage(commands, work_dir: Path, log_path: Path):
+    """Run a stage's commands one after the other in work_dir, returning the wall time and peak resident memory (MB)"""
+
+    env = dict(os.environ)
+    # ESM checkpoints pickle their arguments, which recent PyTorch only loads with this
+    env.setdefault('TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD', '1')
+
+    peak_rss = 0
+    start_time = default_timer()
+    with log_path.open('wt') as log_handle:
+        for command in commands:
+            process = subprocess.Popen(command, cwd=work_dir, stdout=log_handle, stderr=subprocess.STDOUT, env=env)
+            # wait4 gives the resource use of this child alone
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, command, output=f'see {log_path}')
+            peak_rss = max(peak_rss, usage.ru_maxrss / 1024)
+    return default_timer() - start_time, peak_rss
+
+
+def read_output(path: Path):
+    """An output as a frame in a canonical row order (all files of a directory, for processed outputs)"""
+
+    if path.is_dir():
+        return pd.concat(
+            [read_output(file_path).assign(file=file_path.name) for file_path in sorted(path.iterdir())],
+            ignore_index=True
+        )
+    df = pd.read_csv(path, sep='\t' if '.tsv' in path.suffixes else ',')
+    keys = [col for col in df.columns if not pd.api.types.is_float_dtype(df[col])]
+    return df.sort_values(keys).reset_index(drop=True)
+
+
+def compare(output: Path, golden: Path, rtol, atol):
+    """Largest absolute difference in scores between an output and its golden file, and a description of any mismatch"""
+
+    if not golden.exists():
+        return np.nan, f'no golden file {golden}'
+    df = read_output(output)
+    golden_df = read_output(golden)
+    if list(df.columns) != list(golden_df.columns) or df.shape != golden_df.shape:
+        return np.nan, f'{output.name}: shape {df.shape} != {golden_df.shape} or different columns'
+
+    floats = [col for col in df.columns if pd.api.types.is_float_dtype(df[col])]
+    others = [col for col in df.columns if col not in floats]
+    if not df[others].equals(golden_df[others]):
+        return np.nan, f'{output.name}: different rows'
+
+    values = df[floats].to_numpy()
+    golden_values = golden_df[floats].to_numpy()
+    max_diff = np.nanmax(np.abs(values - golden_values), initial=0)
+    if not np.allclose(values, golden_values, rtol=rtol, atol=atol, equal_nan=True):
+        return max_diff, f'{output.name}: scores differ by up to {max_diff:.3g}'
+    return max_diff, None
+
+
+def remove_output(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    for file_path in (path, path.with_name(f'{path.name}.progress')):
+        file_path.unlink(missing_ok=True)
+
+
+def main(args):
+    work_dir = args.work_dir.resolve()
+    output_dir = work_dir / 'outputs'
+    log_dir = work_dir / 'logs'
+    golden_dir = args.golden_dir or work_dir / 'golden'
+    output_dir.mkdir(parents=True, exist_ok=True)
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    inputs = prepare_inputs(work_dir, args)
+    print(
+        f'{args.proteins} proteins ({inputs["long_proteins"]} over {MAX_SEQ_LENTH} AAs, {inputs["positions"]} positions), '
+        f'{args.models} stand-in models ({args.layers} layers, dim {args.dim}, {args.heads} heads), {args.threads} threads'
+    )
+
+    rows = []
+    failures = []
+    for name, commands, outputs, units, unit_name in stages(inputs, output_dir, args):
+        if args.stages and not any(stage in name for stage in args.stages):
+            continue
+        for output in outputs:
+            remove_output(output)
+        seconds, peak_rss = run_stage(commands, work_dir, log_dir / f'{name.replace(" ", "_")}.log')
+        row = {
+            'stage': name,
+            'seconds': seconds,
+            'units': f'{units} {unit_name}',
+            'per_second': units / seconds,
+            'peak_rss_mb': peak_rss
+        }
+
+        if args.update_golden:
+            golden_dir.mkdir(parents=True, exist_ok=True)
+            for output in outputs:
+                golden = golden_dir / output.name
+                remove_output(golden)
+                (shutil.copytree if output.is_dir() else shutil.copy)(output, golden)
+            row['golden'] = 'updated'
+        else:
+            diffs = [compare(output, golden_dir / output.name, args.rtol, args.atol) for output in outputs]
+            row['max_diff'] = max(diff for diff, _ in diffs)
+            problems = [problem for _, problem in diffs if problem]
+            row['golden'] = 'FAIL' if problems else 'ok'
+            failures += [f'{name}: {problem}' for problem in problems]
+
+        rows.append(row)
+        print(f'{name}: {seconds:.1f} s')
+
+    print(pd.DataFrame(rows).to_string(index=False, float_format='{:.4g}'.format))
+    if failures:
+        print('\n'.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Benchmark the pipeline end to end on the CPU with stand-in models')
+    parser.add_argument('--work-dir', type=Path, required=True, help='Directory for models, inputs, outputs and logs')
+    parser.add_argument('--golden-dir', type=Path, help='Directory of golden outputs. Defaults to {work dir}/golden.')
+    parser.add_argument('--update-golden', action='store_true', help='Save the outputs as the golden files')
+    parser.add_argument(
+        '--stages',
+        nargs='+',
+        help=(
+            'Only run stages whose names contain one of these, e.g. predict_substitutions. '
+            'process-results reads the masked-marginals output of an earlier run if that stage is not run.'
+        )
+    )
+    parser.add_argument('--proteins', type=int, default=6, help='Number of synthetic proteins')
+    parser.add_argument('--long-proteins', type=int, default=1, help=f'Minimum number of proteins over {MAX_SEQ_LENTH} AAs')
+    parser.add_argument('--models', type=int, default=1, help='Number of stand-in ESM-1v models')
+    parser.add_argument('--layers', type=int, default=2, help='Layers of the stand-in models')
+    parser.add_argument('--dim', type=int, default=32, help='Embedding dimension of the stand-in models')
+    parser.add_argument(
+        '--heads',
+        type=int,
+        default=1,
+        help='Attention heads of the stand-in models. Attention dominates their run time on long windows.'
+    )
+    parser.add_argument('--dms-length', type=int, default=150, help='Length of the deep mutational scan sequence')
+    parser.add_argument('--dms-mutants', type=int, default=100, help='Number of mutants in the deep mutational scan')
+    parser.add_argument('--msa-depth', type=int, default=32, help='Number of sequences in the synthetic MSA')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--rtol', type=float, default=1e-4)
+    parser.add_argument('--atol', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
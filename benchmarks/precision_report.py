@@ -0,0 +1,107 @@
+"""
+Accuracy report for the reduced-precision compute modes of container/predict_substitutions.py.
+
+Scores a set of sequences with one model under each --compute-precision
+(fp32, bf16, int8) on the given device, and compares the amino acid
+substitution scores of bf16 and int8 against fp32, along with their run times.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from timeit import default_timer
+
+import numpy as np
+import pandas as pd
+from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
+
+from common import load_script, random_sequence
+
+predict_substitutions = load_script('container/predict_substitutions.py')
+inference = load_script('container/inference.py')
+
+
+def synthetic_records(count: int, length: int, seed: int):
+    rng = np.random.default_rng(seed)
+    return [SeqRecord(Seq(random_sequence(length, rng)), id=f'SYNTH{i}') for i in range(count)]
+
+
+def score(records, model_location, runtime, args):
+    """Amino acid scores of every chunk position, concatenated over chunks, and the time taken to compute them."""
+
+    model, alphabet = predict_substitutions.load_model(model_location, runtime)
+    token_indices = [alphabet.get_idx(aa) for aa in predict_substitutions.AA_TOKENS]
+    chunks = predict_substitutions.chunk_sequences(records)
+    if args.scoring_strategy == 'wt-marginals':
+        results = predict_substitutions.run_wt_marginals_model(
+            [model], alphabet, chunks, args.batch_size * (predict_substitutions.MAX_SEQ_LENTH + 2), runtime
+        )
+    else:
+        results = predict_substitutions.run_masked_marginals_model([model], alphabet, chunks, args.batch_size, runtime)
+
+    start_time = default_timer()
+    scores = [chunk_scores[0][:, token_indices] for _, _, chunk_scores in results]
+    elapsed = default_timer() - start_time
+
+    return np.concatenate(scores), elapsed
+
+
+def spearman(x: np.ndarray, y: np.ndarray):
+    return pd.Series(x).rank().corr(pd.Series(y).rank())
+
+
+def main(args):
+    if args.sequences:
+        records = list(predict_substitutions.read_sequences(args.sequences))
+    else:
+        records = synthetic_records(args.count, args.length, args.seed)
+
+    results = {}
+    for compute_precision in args.compute_precisions:
+        runtime = inference.Runtime(args.device, args.threads, args.interop_threads, compute_precision)
+        results[compute_precision] = score(records, args.model_location, runtime, args)
+
+    reference, reference_time = results['fp32']
+    rows = []
+    for compute_precision, (scores, elapsed) in results.items():
+        diff = np.abs(scores - reference)
+        # Agreement on the best substitution at each position
+        top = (scores.argmax(axis=1) == reference.argmax(axis=1)).mean()
+        rows.append({
+            'precision': compute_precision,
+            'seconds': elapsed,
+            'speedup': reference_time / elapsed,
+            'max_abs_diff': diff.max(),
+            'mean_abs_diff': diff.mean(),
+            'spearman': spearman(scores.reshape(-1), reference.reshape(-1)),
+            'top_agreement': top
+        })
+
+    print(f'{reference.shape[0]} positions, {args.scoring_strategy}, {runtime.device}')
+    print(pd.DataFrame(rows).to_string(index=False, float_format='{:.4g}'.format))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Compare reduced-precision compute modes against fp32')
+    parser.add_argument('--model-location', type=str, required=True, help='PyTorch model file OR name of pretrained model')
+    parser.add_argument('--sequences', type=Path, help='FASTA file to score. Defaults to random sequences.')
+    parser.add_argument('--count', type=int, default=4, help='Number of random sequences')
+    parser.add_argument('--length', type=int, default=300, help='Length of random sequences')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scoring-strategy', type=str, default='masked-marginals', choices=['wt-marginals', 'masked-marginals'])
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--interop-threads', type=int)
+    parser.add_argument(
+        '--compute-precisions',
+        nargs='+',
+        choices=inference.COMPUTE_PRECISIONS,
+        help='Modes to compare; fp32 is always included as the reference. Defaults to all modes the device supports.'
+    )
+    args = parser.parse_args()
+    if args.compute_precisions is None:
+        args.compute_precisions = ['fp32', 'bf16', 'int8'] if args.device == 'cpu' else ['fp32', 'bf16']
+    elif 'fp32' not in args.compute_precisions:
+        args.compute_precisions = ['fp32'] + args.compute_precisions
+    main(args)
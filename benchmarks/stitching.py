@@ -0,0 +1,176 @@
+"""
+Benchmark overlap stitching in process-results.py.
+
+Compares the per-protein reshaping and per-variant
+`groupby(...).apply(merge_estimates)` that process-results.py used to run
+(copied verbatim) against `pivot_models` and the columnar `stitch_windows`, on
+a synthetic multi-window protein, and checks that both give the same output.
+"""
+
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+
+from common import best_time, load_script, random_sequence, windows
+
+process_results = load_script('process-results.py')
+
+
+def merge_estimates(df: pd.DataFrame):
+    """Verbatim copy of the per-variant merge process-results.py used to run.
+
+    The only change is reading means by position with .iloc, which recent
+    pandas no longer falls back to for means[0] and means[1].
+    """
+
+    if df.shape[0] == 1:
+        result = df.reset_index(['pos', 'start', 'end'], drop=True)
+        result['combined_score'] = result.mean(axis='columns')
+
+    elif df.shape[0] == 2:
+        sorted = df.sort_values('start')
+
+        line = sorted.iloc[[0],:].reset_index(['pos', 'start', 'end'], drop=True)
+        next_line = (
+            sorted.iloc[[1],:]
+            .reset_index(['pos', 'start', 'end'], drop=True)
+            .rename(columns = lambda s: f'{s}_next')
+        )
+
+        result = pd.concat((line, next_line), axis='columns')
+
+        # Merging calculation
+        # This uses a cosine sigmoid to smoothly transition from the leading
+        # sequence to the trailing sequence. Specifically, the score is
+        # s0 * w + s1 * (1 - w)
+        # where s0 and s1 are the means of the scores for the leading and
+        # trailing sequences respectively. For a position that is p
+        # (proportionally) into the overlap,
+        # w = { 1 for p < 0.2
+        #     { 0 for p > 0.8
+        #     { (1 + cos( pi * (p - 0.2) / 0.6 )) / 2 for p in [0.2, 0.8]
+
+        index_df = sorted.index.to_frame(index=False)
+
+        overlap_start = index_df['end'][0]
+        overlap_end = index_df['start'][1]
+        pos = index_df['pos'][0]
+        relative_pos = pos - overlap_start / (overlap_end - overlap_start)
+
+        means = sorted.mean(axis='columns')
+        if relative_pos < 0.2:
+            score = means.iloc[0]
+        elif relative_pos > 0.8:
+            score = means.iloc[1]
+        else:
+            weight = (1 + np.cos(np.pi * (relative_pos - 0.2) / 0.6)) / 2
+            score = means.iloc[0] * weight + means.iloc[1] * (1-weight)
+        
+        result['combined_score'] = score
+
+    else:
+        raise ValueError(f'Unexpected frame shape: {df.shape}; expected 1 or 2 rows. DF: {df}')
+
+    return result
+
+
+def hgvs_order(ind: pd.Index):
+    """Key for ordering hgvs variants (by sequence ID, then position, then alternate AA)"""
+
+    return pd.Index([
+        (seq, int(pos), alt)
+        for seq, pos, alt in ind.str.extract(r'^([^:]+)[:]p[.][a-zA-Z]{3}(\d+)([a-zA-Z]{3})$').itertuples(index=False)
+    ])
+
+
+def baseline_path(df: pd.DataFrame):
+    """The per-protein reshaping and stitching process-results.py used to run, verbatim."""
+
+    AA_COLS = process_results.AA_COLS
+    AA_NAMES = process_results.AA_NAMES
+    return (
+        df
+        # Pivot longer on alt AAs:
+        .melt(
+            id_vars=['seq', 'start', 'end', 'pos', 'ref', 'model'],
+            value_vars=list(AA_COLS),
+            var_name='alt',
+            value_name='score',
+            ignore_index=True
+        )
+        # Compose HVGS string, i.e. {seq}:p.{ref}{pos}{alt}
+        .assign(
+            HGVS=lambda df: df.seq + ':p.' + df.ref.map(AA_NAMES) + (df.pos + 1).astype(str) + df.alt.map(AA_NAMES)
+        )
+        # Pivot wider on models
+        .pivot(
+            index=['HGVS', 'pos', 'start', 'end'],
+            columns='model',
+            values='score'
+        )
+        # Merge overlapping estimates
+        .groupby('HGVS', group_keys=False).apply(merge_estimates)
+        # Sort nicely, i.e.
+        # by sequence ID, then position, then alternate AA
+        .sort_index(key=hgvs_order)
+    )
+
+
+def stitched_path(df: pd.DataFrame):
+    """The same with the columnar functions process-results.py runs now."""
+
+    return (
+        process_results.pivot_models(df)
+        .pipe(process_results.stitch_windows)
+        .pipe(lambda stitched: process_results.label_variants('SYNTH', stitched))
+    )
+
+
+def synthetic_protein(length: int, n_models: int, seed: int):
+    """Raw predictions for one protein in the layout process-results.py works on."""
+
+    rng = np.random.default_rng(seed)
+    sequence = random_sequence(length, rng)
+    frames = []
+    for start, end in windows(length):
+        for model in range(1, n_models + 1):
+            frame = pd.DataFrame(
+                rng.normal(-5, 2, size=(end - start, len(process_results.AA_COLS))),
+                columns=list(process_results.AA_COLS)
+            )
+            frame.insert(0, 'seq', 'SYNTH')
+            frame.insert(1, 'start', start)
+            frame.insert(2, 'end', end)
+            frame.insert(3, 'pos', np.arange(start, end))
+            frame.insert(4, 'ref', list(sequence[start:end]))
+            frame.insert(5, 'model', f'esm1v_t33_650M_UR90S_{model}')
+            frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def main(args):
+    raw = synthetic_protein(args.length, args.models, args.seed)
+    print(f'{args.length} AA protein, {args.models} models: {raw.shape[0]} (position, window, model) rows')
+
+    baseline_time, baseline = best_time(lambda: baseline_path(raw), args.repeat)
+    stitch_time, stitched = best_time(lambda: stitched_path(raw), args.repeat)
+
+    pd.testing.assert_frame_equal(
+        stitched.sort_index(),
+        baseline.sort_index()[stitched.columns],
+        check_names=False,
+        check_exact=True
+    )
+    print('Outputs match.')
+    print(f'groupby-apply: {baseline_time:.3f} s')
+    print(f'stitch_windows: {stitch_time:.3f} s ({baseline_time / stitch_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Benchmark overlap stitching')
+    parser.add_argument('--length', type=int, default=5000, help='Protein length in AAs')
+    parser.add_argument('--models', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
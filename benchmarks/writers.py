@@ -0,0 +1,78 @@
+"""
+Benchmark the output writers of process-results.py (--writer, --compression-level, --decimals).
+
+Stitches a synthetic protein of typical MANE length, then writes it with each
+configuration and reports the time taken and the size of the file, relative to
+the default (gzip at level 9, full float precision).
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import pandas as pd
+
+from common import best_time, load_script
+from stitching import synthetic_protein
+
+process_results = load_script('process-results.py')
+
+# (writer, compression level, decimals)
+CONFIGURATIONS = [
+    ('gzip', None, None),
+    ('gzip', 6, None),
+    ('gzip', 1, None),
+    ('gzip', 6, 4),
+    ('bgzf', 6, None),
+    ('bgzf', 1, None),
+    ('bgzf', 6, 4),
+    ('bgzf', 1, 4),
+    ('parquet', None, None),
+    ('parquet', None, 4),
+]
+
+
+def main(args):
+    raw = synthetic_protein(args.length, args.models, args.seed)
+    df = process_results.label_variants(
+        'SYNTH',
+        process_results.stitch_windows(process_results.pivot_models(raw))
+    )
+    print(f'{args.length} AA protein, {args.models} models: {df.shape[0]} variants, {args.threads} compression threads')
+
+    rows = []
+    with TemporaryDirectory() as directory:
+        for writer, level, decimals in CONFIGURATIONS:
+            row = {
+                'writer': writer,
+                'level': 'default' if level is None else level,
+                'decimals': 'full' if decimals is None else decimals,
+                'seconds': np.nan,
+                'MB': np.nan
+            }
+            rows.append(row)
+            try:
+                write = process_results.make_writer(writer, level, args.threads, decimals)
+            except ValueError as e:
+                # Kept in the table (as NaN), so a missing writer doesn't go unnoticed
+                print(f'Not measuring {writer}: {e}')
+                continue
+            out_file = Path(directory) / f'out{process_results.WRITERS[writer]}'
+            row['seconds'], _ = best_time(lambda: write(df, out_file), args.repeat)
+            row['MB'] = out_file.stat().st_size / 1e6
+
+    table = pd.DataFrame(rows)
+    table['speedup'] = table['seconds'].iloc[0] / table['seconds']
+    table['relative_size'] = table['MB'] / table['MB'].iloc[0]
+    print(table.to_string(index=False, float_format='{:.3g}'.format))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser('Benchmark processed output writers')
+    parser.add_argument('--length', type=int, default=560, help='Protein length in AAs (about the mean MANE protein)')
+    parser.add_argument('--models', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=4, help='Compression threads for bgzf')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,233 @@
+"""
+Split sequences into FASTA bundles with roughly equal predicted GPU time.
+
+The cost of a protein is estimated from its windows (see container/windowing.py,
+shared with predict_substitutions.py). A window of w AAs runs as sequences of w + 2 tokens,
+and each token costs about c1 (linear layers) plus c2 x (w + 2) (attention)
+seconds. masked-marginals runs one sequence per position, so a window costs
+    w x (w + 2) x (c1 + c2 x (w + 2))
+while wt-marginals runs the window once:
+    (w + 2) x (c1 + c2 x (w + 2))
+
+The coefficients default to a rough estimate for ESM-1v on a recent GPU, and
+can be calibrated from earlier jobs: given their FASTA files and stdout logs,
+the times predict_substitutions.py prints are fitted against the features of
+the FASTA by least squares.
+
+Proteins are then packed into bundles, largest first, each going to the
+bundle with the least predicted time so far. Bundles are written to the output
+directory along with bundles.tsv (predicted seconds per bundle) and a submit
+file based on chtc/run.submit, with the GPU job length that fits the longest bundle.
+"""
+
+from pathlib import Path
+import gzip
+import heapq
+import re
+import sys
+
+import numpy as np
+from Bio import SeqIO
+
+# The windowing of the prediction script
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'container'))
+from windowing import windows
+
+# Seconds per token for linear layers and per token pair for attention
+# (ESM-1v, 650M parameters, ~100 TFLOPS effective)
+DEFAULT_COEFFICIENTS = (1.3e-5, 1.7e-9)
+
+# Timing lines printed by predict_substitutions.py
+TIMING_PATTERNS = {
+    'masked-marginals': re.compile(r'^It took ([\d.eE+-]+) to generate predictions', re.MULTILINE),
+    'wt-marginals': re.compile(r'^It took ([\d.eE+-]+) seconds to process \d+ sequence chunks', re.MULTILINE)
+}
+
+# CHTC GPU Lab job lengths, and the longest run time (in hours) each allows
+GPU_JOB_LENGTHS = [('short', 12), ('medium', 24), ('long', 168)]
+
+# The submit file that bundle submit files are derived from
+SUBMIT_FILE = Path(__file__).resolve().parent / 'chtc' / 'run.submit'
+
+
+def create_parser():
+    """Command line argument parser. This also serves as a reference."""
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser('Split sequences into bundles of about equal predicted GPU time')
+    parser.add_argument(
+        '--sequences',
+        type=Path,
+        nargs='+',
+        help='FASTA files (can be gzipped) of the sequences to bundle.'
+    )
+    parser.add_argument(
+        '--output-dir',
+        type=Path,
+        help='Directory to write bundle_{i}.fasta, bundles.tsv and run.submit to.'
+    )
+    parser.add_argument(
+        '--scoring-strategy',
+        type=str,
+        default='masked-marginals',
+        choices=['wt-marginals', 'masked-marginals']
+    )
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument(
+        '--bundles',
+        type=int,
+        help='Number of bundles to make.'
+    )
+    size.add_argument(
+        '--bundle-hours',
+        type=float,
+        default=4,
+        help='Predicted GPU hours per bundle (per model), used to choose the number of bundles. Defaults to 4.'
+    )
+    parser.add_argument(
+        '--calibrate',
+        type=Path,
+        nargs=2,
+        action='append',
+        metavar=('FASTA', 'LOG'),
+        help=(
+            'Input FASTA and stdout log of an earlier prediction job with the same scoring strategy. '
+            'Can be repeated; with several jobs of varied protein lengths, both coefficients are fitted.'
+        )
+    )
+    parser.add_argument(
+        '--coefficients',
+        type=float,
+        nargs=2,
+        default=DEFAULT_COEFFICIENTS,
+        metavar=('C1', 'C2'),
+        help='Cost coefficients to use without --calibrate (see module docstring).'
+    )
+    return parser
+
+
+def read_sequences(path: Path):
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rt') as in_handle:
+        yield from SeqIO.parse(in_handle, 'fasta')
+
+
+def cost_features(length, scoring_strategy):
+    """Features (tokens, token pairs) that the cost of a protein is linear in"""
+
+    tokens = 0
+    pairs = 0
+    for start, end in windows(length):
+        runs = end - start if scoring_strategy == 'masked-marginals' else 1
+        tokens += runs * (end - start + 2)
+        pairs += runs * (end - start + 2) ** 2
+    return np.array([tokens, pairs], dtype=float)
+
+
+def calibrate(jobs, scoring_strategy):
+    """Fit the cost coefficients to (FASTA, log) pairs of earlier jobs"""
+
+    features = []
+    seconds = []
+    for fasta_path, log_path in jobs:
+        times = [float(time) for time in TIMING_PATTERNS[scoring_strategy].findall(log_path.read_text())]
+        if not times:
+            raise ValueError(f'No {scoring_strategy} timing lines in {log_path}')
+        features.append(sum(cost_features(len(record), scoring_strategy) for record in read_sequences(fasta_path)))
+        # One timing line per model run, or per batch for wt-marginals
+        if scoring_strategy == 'masked-marginals':
+            seconds.append(np.mean(times))
+        else:
+            seconds.append(np.sum(times))
+    features = np.array(features)
+    seconds = np.array(seconds)
+
+    coefficients, *_ = np.linalg.lstsq(features, seconds, rcond=None)
+    if (coefficients < 0).any():
+        # Not enough spread in lengths to tell the terms apart; scale the default ratio instead
+        default = np.array(DEFAULT_COEFFICIENTS)
+        coefficients = default * (features @ default @ seconds) / np.sum((features @ default) ** 2)
+
+    error = np.abs(features @ coefficients - seconds) / seconds
+    print(f'Calibrated coefficients {coefficients} on {len(seconds)} jobs (mean relative error {error.mean():.1%})')
+    return coefficients
+
+
+def pack(costs, n_bundles):
+    """Assign items to n_bundles bundles, largest first, each to the bundle with the smallest total so far.
+
+    Returns a list of (total cost, item indices) per bundle.
+    """
+
+    heap = [(0.0, i) for i in range(n_bundles)]
+    bundles = [[] for _ in range(n_bundles)]
+    totals = [0.0] * n_bundles
+    for index in sorted(range(len(costs)), key=lambda index: -costs[index]):
+        total, bundle = heapq.heappop(heap)
+        bundles[bundle].append(index)
+        totals[bundle] = total + costs[index]
+        heapq.heappush(heap, (totals[bundle], bundle))
+    return [(totals[bundle], sorted(bundles[bundle])) for bundle in range(n_bundles)]
+
+
+def submit_file(n_bundles, max_hours, job_length, scoring_strategy):
+    """chtc/run.submit, adapted to run the bundles"""
+
+    text = SUBMIT_FILE.read_text()
+    substitutions = [
+        (r'^# HTC Submit File\n', lambda m: (
+            f'{m[0]}# Generated by bundle-sequences.py from chtc/run.submit: '
+            f'{n_bundles} bundles, at most {max_hours:.1f} predicted hours per model.\n'
+        )),
+        (r'^\+GPUJobLength = .*$', lambda m: f'+GPUJobLength = "{job_length}"'),
+        (r'^(arguments = .*--results \S+)', lambda m: f'{m[1]} --scoring-strategy {scoring_strategy}'),
+        (r'^queue (.*) \S+$', lambda m: f'queue {m[1]} bundle_*.fasta'),
+    ]
+    for pattern, replacement in substitutions:
+        text, count = re.subn(pattern, replacement, text, count=1, flags=re.MULTILINE)
+        if count != 1:
+            raise ValueError(f'{SUBMIT_FILE} has no line matching {pattern}')
+    return text
+
+
+def main(args):
+
+    if args.calibrate:
+        coefficients = calibrate(args.calibrate, args.scoring_strategy)
+    else:
+        coefficients = np.array(args.coefficients)
+
+    records = [record for path in args.sequences for record in read_sequences(path)]
+    if not records:
+        raise ValueError(f'No sequences in {[str(path) for path in args.sequences]}')
+    costs = [cost_features(len(record), args.scoring_strategy) @ coefficients for record in records]
+    total = sum(costs)
+
+    n_bundles = args.bundles or max(1, int(np.ceil(total / (args.bundle_hours * 3600))))
+    n_bundles = min(n_bundles, len(records))
+    bundles = pack(costs, n_bundles)
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    with (args.output_dir / 'bundles.tsv').open('wt') as summary:
+        summary.write('bundle\tsequences\tpredicted_seconds\n')
+        for i, (bundle_cost, indices) in enumerate(bundles):
+            SeqIO.write([records[index] for index in indices], args.output_dir / f'bundle_{i}.fasta', 'fasta')
+            summary.write(f'bundle_{i}\t{len(indices)}\t{bundle_cost:.0f}\n')
+
+    max_hours = max(bundle_cost for bundle_cost, _ in bundles) / 3600
+    job_length = next((name for name, hours in GPU_JOB_LENGTHS if max_hours <= hours), GPU_JOB_LENGTHS[-1][0])
+    (args.output_dir / 'run.submit').write_text(
+        submit_file(n_bundles, max_hours, job_length, args.scoring_strategy)
+    )
+
+    print(
+        f'{len(records)} sequences, {total / 3600:.1f} predicted GPU hours per model, '
+        f'in {n_bundles} bundles of {min(bundle_cost for bundle_cost, _ in bundles) / 3600:.2f}'
+        f'-{max_hours:.2f} hours ({job_length} jobs)'
+    )
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args()
+    main(args)
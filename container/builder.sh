@@ -4,3 +4,4 @@ apptainer build --build-arg MODEL=esm1v_t33_650M_UR90S_2.pt build/model2v3.sif c
 apptainer build --build-arg MODEL=esm1v_t33_650M_UR90S_3.pt build/model3v3.sif container.def
 apptainer build --build-arg MODEL=esm1v_t33_650M_UR90S_4.pt build/model4v3.sif container.def
 apptainer build --build-arg MODEL=esm1v_t33_650M_UR90S_5.pt build/model5v3.sif container.def
+apptainer build build/ensemblev3.sif ensemble.def
@@ -0,0 +1,277 @@
+"""
+Convert ESM checkpoints to memory-mapped weight files, and load models from them.
+
+`pretrained.load_model_and_alphabet` unpickles a whole `.pt` checkpoint,
+builds the model with freshly initialized fp32 weights and then copies the
+checkpoint's weights into them. A converted checkpoint
+(`{model name}.safetensors`) is instead laid out in the safetensors format:
+* 8 bytes: the length of the header, little-endian.
+* The header: JSON mapping each tensor name to its dtype, shape and the byte
+  range of its data, with `__metadata__` holding the model class, its
+  arguments, the alphabet, tied weights and the SHA-256 of the data (see
+  METADATA_FORMAT).
+* The data of every tensor, one after the other.
+
+load_model_and_alphabet builds the model without allocating weights (on the
+meta device) and points its parameters straight at a private memory map of
+the file, so loading costs about as much as the page faults of the weights
+that are used, and processes on a node that load the same file share its
+pages. Weights can be stored as float16 or bfloat16 to halve the file;
+Runtime.prepare in inference.py casts them back to float32 for fp32 compute.
+
+Convert with
+```
+python checkpoints.py --model-location esm_models/esm1v_t33_650M_UR90S_1.pt --output-dir esm_models
+```
+"""
+
+from argparse import Namespace
+from pathlib import Path
+import hashlib
+import json
+import mmap
+import struct
+
+import torch
+from esm import Alphabet, MSATransformer, ProteinBertModel, pretrained
+
+CHECKPOINT_SUFFIX = '.safetensors'
+# Written to the metadata, checked when loading
+METADATA_FORMAT = 'esm-checkpoint-1'
+
+MODEL_TYPES = {model_type.__name__: model_type for model_type in (ProteinBertModel, MSATransformer)}
+
+DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16
+}
+# Names of tensor dtypes in the safetensors format
+SAFETENSORS_DTYPES = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL'
+}
+TORCH_DTYPES = {name: dtype for dtype, name in SAFETENSORS_DTYPES.items()}
+
+
+def create_parser():
+    """Command line argument parser. This also serves as a reference."""
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser('Convert ESM checkpoints to memory-mapped weight files')
+    parser.add_argument(
+        '--model-location',
+        type=str,
+        nargs='+',
+        help='PyTorch model files (.pt) OR names of pretrained models to download.'
+    )
+    parser.add_argument(
+        '--output-dir',
+        type=Path,
+        help=f'Directory to write the converted checkpoints to, as {{model name}}{CHECKPOINT_SUFFIX}.'
+    )
+    parser.add_argument(
+        '--dtype',
+        type=str,
+        default='float32',
+        choices=list(DTYPES),
+        help=(
+            'Precision to store floating point weights in. '
+            'float16 and bfloat16 halve the file, at the cost of rounding the weights.'
+        )
+    )
+    return parser
+
+
+def is_checkpoint(model_location):
+    return str(model_location).endswith(CHECKPOINT_SUFFIX)
+
+
+def model_metadata(model, alphabet):
+    """Everything besides the weights needed to build model and alphabet again"""
+
+    model_type = type(model).__name__
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f'Converting {model_type} models is not supported; expected one of {list(MODEL_TYPES)}')
+
+    # Arguments that don't serialize (none that the models read) are left out
+    args = {}
+    for name, value in vars(model.args).items():
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+        args[name] = value
+
+    return {
+        'format': METADATA_FORMAT,
+        'model_type': model_type,
+        'args': args,
+        'alphabet': {
+            'standard_toks': alphabet.standard_toks,
+            'prepend_toks': alphabet.prepend_toks,
+            'append_toks': alphabet.append_toks,
+            'prepend_bos': alphabet.prepend_bos,
+            'append_eos': alphabet.append_eos,
+            'use_msa': alphabet.use_msa
+        }
+    }
+
+
+def save_checkpoint(model, alphabet, path, dtype=torch.float32):
+    """Write a model and its alphabet as a checkpoint, with floating point weights in dtype"""
+
+    # Tied weights (e.g. the language model head and the token embedding) are stored once
+    tensors = {}
+    tied = {}
+    names_by_pointer = {}
+    for name, tensor in model.state_dict().items():
+        pointer = tensor.data_ptr()
+        if pointer in names_by_pointer and tensors[names_by_pointer[pointer]].shape == tensor.shape:
+            tied[name] = names_by_pointer[pointer]
+            continue
+        names_by_pointer[pointer] = name
+        if tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensors[name] = tensor.detach().cpu().contiguous()
+
+    # Larger elements first, so every tensor's data is aligned to its element size
+    names = sorted(tensors, key=lambda name: -tensors[name].element_size())
+    header = {}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {
+            'dtype': SAFETENSORS_DTYPES[tensor.dtype],
+            'shape': list(tensor.shape),
+            'data_offsets': [offset, offset + size]
+        }
+        offset += size
+    metadata = model_metadata(model, alphabet)
+    metadata['tied'] = tied
+    # Identifies the weights without reading them (e.g. for the prediction cache's model keys)
+    digest = hashlib.sha256()
+    for name in names:
+        digest.update(tensors[name].view(-1).view(torch.uint8).numpy())
+    metadata['sha256'] = digest.hexdigest()
+    header['__metadata__'] = {key: json.dumps(value) for key, value in metadata.items()}
+
+    header = json.dumps(header, separators=(',', ':')).encode()
+    # Pad the header so that the data starts at a multiple of 8 bytes
+    header += b' ' * (-len(header) % 8)
+
+    temporary_path = path.with_name(f'{path.name}.tmp')
+    with temporary_path.open('wb') as out_handle:
+        out_handle.write(struct.pack('<Q', len(header)))
+        out_handle.write(header)
+        for name in names:
+            out_handle.write(tensors[name].view(-1).view(torch.uint8).numpy().tobytes())
+    temporary_path.replace(path)
+
+
+def read_header(in_handle):
+    """Length of the header of the checkpoint open in in_handle, its tensor entries, and its metadata"""
+
+    header_length, = struct.unpack('<Q', in_handle.read(8))
+    header = json.loads(in_handle.read(header_length))
+    metadata = {key: json.loads(value) for key, value in header.pop('__metadata__', {}).items()}
+    if metadata.get('format') != METADATA_FORMAT:
+        raise ValueError(f'{in_handle.name} is not a checkpoint written by checkpoints.py ({METADATA_FORMAT})')
+    return header_length, header, metadata
+
+
+def read_metadata(path):
+    """Metadata of a checkpoint, reading only its header"""
+
+    with open(path, 'rb') as in_handle:
+        return read_header(in_handle)[2]
+
+
+def read_checkpoint(path):
+    """Tensors and metadata of a checkpoint, the tensors backed by a private memory map of the file"""
+
+    with open(path, 'rb') as in_handle:
+        header_length, header, metadata = read_header(in_handle)
+        # Copy-on-write: pages are read from (and shared through) the page cache until written to
+        mapped = mmap.mmap(in_handle.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    tensors = {}
+    data_start = 8 + header_length
+    for name, entry in header.items():
+        dtype = TORCH_DTYPES[entry['dtype']]
+        begin, end = entry['data_offsets']
+        if end == begin:
+            tensors[name] = torch.empty(entry['shape'], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(
+            mapped, dtype=dtype, count=(end - begin) // torch.empty((), dtype=dtype).element_size(),
+            offset=data_start + begin
+        ).view(entry['shape'])
+    return tensors, metadata
+
+
+def load_checkpoint(path):
+    """Build a model and its alphabet from a checkpoint, with parameters that map the file (zero-copy)"""
+
+    tensors, metadata = read_checkpoint(path)
+    alphabet = Alphabet(**metadata['alphabet'])
+
+    # Parameters on the meta device have no storage, so initializing them writes nothing;
+    # the checkpoint's tensors are assigned to them below
+    with torch.device('meta'):
+        model = MODEL_TYPES[metadata['model_type']](Namespace(**metadata['args']), alphabet)
+
+    assigned = {}
+    for name in list(tensors) + list(metadata['tied']):
+        source = metadata['tied'].get(name, name)
+        module_name, _, attribute = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        if isinstance(getattr(module, attribute, None), torch.nn.Parameter):
+            if source not in assigned:
+                assigned[source] = torch.nn.Parameter(tensors[source], requires_grad=False)
+            setattr(module, attribute, assigned[source])
+        elif attribute in module._buffers:
+            setattr(module, attribute, tensors[source])
+        else:
+            raise ValueError(f'{path} has a tensor {name} that {metadata["model_type"]} does not')
+
+    missing = [
+        name for name, tensor in [*model.named_parameters(), *model.named_buffers()] if tensor.is_meta
+    ]
+    if missing:
+        raise ValueError(f'{path} has no weights for {", ".join(missing)}')
+    return model, alphabet
+
+
+def load_model_and_alphabet(model_location):
+    """Load a converted checkpoint (see load_checkpoint), or anything pretrained.load_model_and_alphabet takes"""
+
+    if is_checkpoint(model_location):
+        return load_checkpoint(model_location)
+    return pretrained.load_model_and_alphabet(model_location)
+
+
+def main(args):
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    for model_location in args.model_location:
+        model, alphabet = pretrained.load_model_and_alphabet(model_location)
+        name = Path(model_location).stem if model_location.endswith('.pt') else model_location
+        path = args.output_dir / f'{name}{CHECKPOINT_SUFFIX}'
+        save_checkpoint(model, alphabet, path, DTYPES[args.dtype])
+        print(f'Converted {model_location} to {path} ({path.stat().st_size / 2**20:.0f} MB, {args.dtype})')
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,141 @@
+"""Device, thread and precision settings for running ESM models, shared by the prediction scripts."""
+
+import os
+from contextlib import nullcontext
+
+import torch
+from esm.multihead_attention import MultiheadAttention
+
+COMPUTE_PRECISIONS = ['fp32', 'bf16', 'int8']
+
+
+def add_arguments(parser):
+    """Add the --device, --threads, --interop-threads and --compute-precision options to parser."""
+
+    parser.add_argument(
+        '--device',
+        type=str,
+        default='auto',
+        help=(
+            'Device to run models on: auto (the GPU if available, else the CPU), cpu, cuda, '
+            'or a torch device such as cuda:1.'
+        )
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=int(os.environ.get('OMP_NUM_THREADS', 0)) or None,
+        help=(
+            'Number of threads for CPU inference. '
+            'Defaults to OMP_NUM_THREADS, which HTCondor sets to request_cpus, '
+            "or PyTorch's default if that is not set."
+        )
+    )
+
+    parser.add_argument(
+        '--interop-threads',
+        type=int,
+        help='Number of threads PyTorch uses to run independent operations in parallel. Defaults to 1 on CPU.'
+    )
+
+    parser.add_argument(
+        '--compute-precision',
+        type=str,
+        default='fp32',
+        choices=COMPUTE_PRECISIONS,
+        help=(
+            'Precision of model compute. '
+            'bf16: run the model under bfloat16 autocast. '
+            'int8: dynamically quantize the weights of linear layers to int8 (CPU only). '
+            'See benchmarks/precision_report.py for how these compare with fp32.'
+        )
+    )
+
+
+class Runtime:
+    """Where and how models run: device, CPU threads and compute precision."""
+
+    def __init__(self, device='auto', threads=None, interop_threads=None, compute_precision='fp32'):
+        if device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.compute_precision = compute_precision
+
+        if compute_precision not in COMPUTE_PRECISIONS:
+            raise ValueError(f'Unknown compute precision {compute_precision}; expected one of {COMPUTE_PRECISIONS}')
+        if compute_precision == 'int8' and self.device.type != 'cpu':
+            raise ValueError('int8 dynamic quantization is only available on the CPU')
+
+        if self.device.type == 'cpu':
+            if threads:
+                torch.set_num_threads(threads)
+            # Batches are a handful of large matrix products, intra-op threads do the work.
+            interop_threads = interop_threads or 1
+        if interop_threads:
+            # Inter-op threads can only be set once, before any parallel work has run
+            # (e.g. by an earlier Runtime in the same process).
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError:
+                pass
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            device=args.device,
+            threads=args.threads,
+            interop_threads=args.interop_threads,
+            compute_precision=args.compute_precision
+        )
+
+    def __str__(self):
+        if self.device.type == 'cpu':
+            return f'{self.device} ({torch.get_num_threads()} threads, {self.compute_precision})'
+        return f'{self.device} ({self.compute_precision})'
+
+    def prepare(self, model):
+        """Put a freshly loaded model in eval mode on the device, quantizing it for int8.
+
+        Weights stored in half precision (see checkpoints.py) are cast to float32,
+        on a GPU after moving them there, so half as many bytes are copied.
+        Compute precision is still set by compute_precision.
+        """
+
+        model.eval()
+
+        upcast = next(model.parameters()).dtype != torch.float32
+        if upcast and self.device.type == 'cpu':
+            model = model.float()
+
+        if self.compute_precision == 'int8':
+            # The fused attention path reads the projection weights directly,
+            # which quantized linear layers don't expose; use the unfused path.
+            for module in model.modules():
+                if isinstance(module, MultiheadAttention):
+                    module.enable_torch_version = False
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+        model = model.to(self.device)
+        if upcast:
+            model = model.float()
+        return model
+
+    def autocast(self):
+        """Context in which to run models, applying bf16 autocast if selected"""
+
+        if self.compute_precision == 'bf16':
+            return torch.autocast(self.device.type, dtype=torch.bfloat16)
+        return nullcontext()
+
+    def to_device(self, tokens):
+        """Move a batch of tokens to the device without blocking the host."""
+
+        return tokens.to(self.device, non_blocking=True)
+
+    def pin(self, tokens):
+        """Put a batch of tokens in pinned host memory, if it is going to be copied to a GPU."""
+
+        if self.device.type == 'cuda':
+            return tokens.pin_memory()
+        return tokens
@@ -0,0 +1,283 @@
+"""Structured timing and resource metrics of prediction jobs, written as JSON lines.
+
+Metrics are off unless a script calls configure with a path (the --metrics
+option), in which case the file gets one JSON object per line:
+* `job`: Host, command line arguments and runtime, at the start of the job.
+* `model_load`: The time taken to load each model.
+* `batch`: One per model batch: rows, positions scored, padded and real token
+  counts, seconds (waiting for the device to finish), and the chunks in the
+  batch with their number of positions, so time can be attributed to proteins.
+* `probe`, `oom`: The batch size probed at startup, and batches that ran out of
+  memory and were split (see predict_substitutions.BatchLimits).
+* `profile`: The top operations of the batch run under the PyTorch profiler
+  (--profile-batch), whose chrome trace is written next to the metrics file.
+* `summary`: At the end of the job: wall time, seconds spent in each stage,
+  counters (positions, tokens), padding fraction and peak memory.
+
+Stages are timed exclusively: while a stage is entered inside another (e.g.
+FASTA parsing pulled through chunking), the time counts towards the inner one
+only. Stage times are per thread, and batches are built in a background thread
+(see predict_substitutions.prefetch), so stages can add up to more than the wall time.
+summarize-metrics.py aggregates these files over a run directory.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from timeit import default_timer
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+import torch
+
+
+def add_arguments(parser):
+    """Add the --metrics and --profile-batch options to parser."""
+
+    parser.add_argument(
+        '--metrics',
+        type=str,
+        help=(
+            'JSON-lines file to record stage timings, batch sizes, padding and peak memory to (see metrics.py). '
+            'summarize-metrics.py summarizes these over a run.'
+        )
+    )
+
+    parser.add_argument(
+        '--profile-batch',
+        type=int,
+        help='Run this model batch (counting from 0) under the PyTorch profiler, writing a trace next to --metrics.'
+    )
+
+
+def synchronize(device):
+    """Wait for work queued on a GPU device to finish, so that it is timed where it runs."""
+
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class Metrics:
+    """Records metrics to a JSON-lines file, or does nothing if path is None."""
+
+    def __init__(self, path=None, profile_batch=None):
+        self.path = path
+        self.enabled = path is not None
+        self.profile_batch = profile_batch
+        self.start_time = default_timer()
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.out_handle = None
+        if self.enabled:
+            with open(path, 'ab+') as out_handle:
+                # End a line left partially written by an earlier attempt at the job (e.g. one that was evicted)
+                if out_handle.seek(0, os.SEEK_END) > 0:
+                    out_handle.seek(-1, os.SEEK_END)
+                    if out_handle.read(1) != b'\n':
+                        out_handle.write(b'\n')
+            self.out_handle = open(path, 'at')
+
+    def record(self, event, **fields):
+        """Write a record of an event"""
+
+        if not self.enabled:
+            return
+        line = json.dumps({'event': event, 'time': time.time(), **fields}, default=str)
+        with self.lock:
+            self.out_handle.write(line + '\n')
+            self.out_handle.flush()
+
+    def count(self, **counters):
+        if not self.enabled:
+            return
+        with self.lock:
+            for name, value in counters.items():
+                self.counters[name] += value
+
+    def _add_time(self, name, seconds):
+        with self.lock:
+            self.stages[name] += seconds
+
+    @contextmanager
+    def _stage(self, name, device):
+        # Stack of [stage name, time it was last resumed] of this thread
+        stack = self.local.__dict__.setdefault('stack', [])
+        now = default_timer()
+        if stack:
+            self._add_time(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+            synchronize(device)
+        finally:
+            now = default_timer()
+            self._add_time(name, now - stack.pop()[1])
+            if stack:
+                stack[-1][1] = now
+
+    def stage(self, name, device=None):
+        """Context that adds the time spent in it to stage name, first waiting for device to finish its work"""
+
+        if not self.enabled:
+            return nullcontext()
+        return self._stage(name, device)
+
+    def timed(self, name, iterable):
+        """Iterate over iterable, adding the time taken to produce each item to stage name"""
+
+        if not self.enabled:
+            return iterable
+        return self._timed(name, iterable)
+
+    def _timed(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    @contextmanager
+    def _model_batch(self, device, fields):
+        index = self.batches
+        self.batches += 1
+        profiling = index == self.profile_batch
+        profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU] + (
+                [torch.profiler.ProfilerActivity.CUDA] if torch.device(device).type == 'cuda' else []
+            ),
+            record_shapes=True
+        ) if profiling else nullcontext()
+
+        start_time = default_timer()
+        with profiler:
+            yield
+            synchronize(device)
+        seconds = default_timer() - start_time
+
+        self.count(
+            batches=1,
+            positions=fields.get('positions', 0),
+            padded_tokens=fields.get('padded_tokens', 0),
+            real_tokens=fields.get('real_tokens', 0)
+        )
+        self.record('batch', index=index, seconds=seconds, **fields)
+
+        if profiling:
+            trace_path = f'{self.path}.trace.json'
+            profiler.export_chrome_trace(trace_path)
+            sort_by = 'device_time_total' if torch.device(device).type == 'cuda' else 'cpu_time_total'
+            operations = sorted(profiler.key_averages(), key=lambda event: getattr(event, sort_by), reverse=True)
+            self.record('profile', index=index, trace=trace_path, operations=[
+                {
+                    'name': event.key,
+                    'calls': event.count,
+                    'cpu_seconds': event.cpu_time_total / 1e6,
+                    'device_seconds': getattr(event, 'device_time_total', 0) / 1e6
+                }
+                for event in operations[:20]
+            ])
+
+    def model_batch(self, device, **fields):
+        """Context for running one batch through the models on device, recorded with fields.
+
+        Fields positions, padded_tokens and real_tokens are also added to the job's counters.
+        """
+
+        if not self.enabled:
+            return nullcontext()
+        return self._model_batch(device, fields)
+
+    def summary(self, **fields):
+        """Record the totals of the job"""
+
+        if not self.enabled:
+            return
+        # ru_maxrss is in kilobytes on Linux
+        memory = {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if torch.cuda.is_initialized():
+            memory['peak_gpu_allocated_mb'] = torch.cuda.max_memory_allocated() / 2**20
+            memory['peak_gpu_reserved_mb'] = torch.cuda.max_memory_reserved() / 2**20
+        padded_tokens = self.counters.get('padded_tokens', 0)
+        self.record(
+            'summary',
+            wall_seconds=default_timer() - self.start_time,
+            stages=dict(self.stages),
+            counters=dict(self.counters),
+            padding_fraction=1 - self.counters.get('real_tokens', 0) / padded_tokens if padded_tokens else None,
+            **memory,
+            **fields
+        )
+
+    def close(self):
+        if self.out_handle is not None:
+            self.out_handle.close()
+            self.out_handle = None
+            self.enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Record the summary, with the exception that ended the job if there was one, and close"""
+
+        self.summary(status='completed' if exc_type is None else f'failed: {exc_type.__name__}')
+        self.close()
+
+
+# The metrics of this process, used through the functions below
+recorder = Metrics()
+
+
+def configure(path=None, profile_batch=None, **job_fields):
+    """Start recording metrics to path (nothing if None), beginning with a job record of job_fields."""
+
+    global recorder
+    recorder.close()
+    recorder = Metrics(path, profile_batch)
+    recorder.record(
+        'job',
+        host=socket.gethostname(),
+        pid=os.getpid(),
+        argv=sys.argv,
+        torch=torch.__version__,
+        cuda_device=torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+        **job_fields
+    )
+    return recorder
+
+
+def record(event, **fields):
+    recorder.record(event, **fields)
+
+
+def count(**counters):
+    recorder.count(**counters)
+
+
+def stage(name, device=None):
+    return recorder.stage(name, device)
+
+
+def timed(name, iterable):
+    return recorder.timed(name, iterable)
+
+
+def model_batch(device, **fields):
+    return recorder.model_batch(device, **fields)
+
+
+def summary(**fields):
+    recorder.summary(**fields)
+
+
+def close():
+    recorder.close()
@@ -4,42 +4,140 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import gzip
+import mmap
 import pathlib
 import string
+import time
 
 import torch
 
-from esm import Alphabet, FastaBatchedDataset, ProteinBertModel, pretrained, MSATransformer
+from esm import Alphabet, FastaBatchedDataset, ProteinBertModel, MSATransformer
 import pandas as pd
 from tqdm import tqdm
-from Bio import SeqIO
 import itertools
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Tuple
 import numpy as np
 
-
-def remove_insertions(sequence: str) -> str:
-    """ Removes any insertions into the sequence. Needed to load aligned sequences in an MSA. """
-    # This is an efficient way to delete lowercase characters and insertion characters from a string
-    deletekeys = dict.fromkeys(string.ascii_lowercase)
-    deletekeys["."] = None
-    deletekeys["*"] = None
-
-    translation = str.maketrans(deletekeys)
-    return sequence.translate(translation)
-
-
-def read_msa(filename: str, nseq: int) -> List[Tuple[str, str]]:
-    """ Reads the first nseq sequences from an MSA file, automatically removes insertions.
-    
-    The input file must be in a3m format (although we use the SeqIO fasta parser)
-    for remove_insertions to work properly."""
-
-    msa = [
-        (record.description, remove_insertions(str(record.seq)))
-        for record in itertools.islice(SeqIO.parse(filename, "fasta"), nseq)
-    ]
-    return msa
+import checkpoints
+import inference
+import metrics
+from predict_substitutions import read_sequences, run_masked_marginals_model, score_tokens, window_hash
+
+
+# Three-letter amino acid codes used in the HGVS IDs of processed predictions (see process-results.py)
+AA_NAMES = {
+    "A": "Ala", "R": "Arg", "N": "Asn", "D": "Asp", "C": "Cys", "Q": "Gln", "E": "Glu", "G": "Gly",
+    "H": "His", "I": "Ile", "L": "Leu", "K": "Lys", "M": "Met", "F": "Phe", "P": "Pro", "S": "Ser",
+    "T": "Thr", "W": "Trp", "Y": "Tyr", "V": "Val", "U": "Sec", "O": "Pyl",
+}
+
+# Lowercase letters (insertions relative to the query) and insertion characters in a3m
+A3M_INSERTIONS = string.ascii_lowercase.encode() + b".*"
+GAP = ord("-")
+# Suffixes of the processed outputs of process-results.py (see its --writer)
+PROCESSED_SUFFIXES = (".tsv.gz", ".parquet")
+
+
+def read_a3m(filename) -> Iterator[Tuple[str, bytes]]:
+    """ Streams (description, aligned sequence) records from an a3m file, removing insertions
+    with a single bytes.translate per record. Uncompressed files are memory-mapped. """
+
+    path = pathlib.Path(filename)
+    if path.suffix == ".gz":
+        handle = gzip.open(path, "rb")
+    elif path.stat().st_size > 0:
+        with path.open("rb") as file:
+            handle = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        return
+    lines = iter(handle.readline, b"")
+
+    with handle:
+        description = None
+        sequence = []
+        for line in lines:
+            if line.startswith(b">"):
+                if description is not None:
+                    yield description, b"".join(sequence).translate(None, A3M_INSERTIONS)
+                description = line[1:].strip().decode()
+                sequence = []
+            else:
+                sequence.append(line.strip())
+        if description is not None:
+            yield description, b"".join(sequence).translate(None, A3M_INSERTIONS)
+
+
+def max_identity_filter(records: Iterable[Tuple[str, bytes]], nseq: int, max_identity: float) -> List[Tuple[str, bytes]]:
+    """ hhfilter-style filtering: takes records in order, the query always, skipping any record whose
+    identity (over columns where both are not gaps) to a record already taken exceeds max_identity.
+    Stops reading once nseq records are taken. """
+
+    taken = []
+    kept = None
+    for description, sequence in records:
+        row = np.frombuffer(sequence, dtype=np.uint8)
+        if kept is not None:
+            aligned = (kept != GAP) & (row != GAP)
+            identity = ((kept == row) & aligned).sum(axis=1) / np.maximum(aligned.sum(axis=1), 1)
+            if (identity > max_identity).any():
+                continue
+            kept = np.vstack([kept, row])
+        else:
+            kept = row[np.newaxis]
+        taken.append((description, sequence))
+        if len(taken) == nseq:
+            break
+    return taken
+
+
+def greedy_diverse(records: Iterable[Tuple[str, bytes]], nseq: int) -> List[Tuple[str, bytes]]:
+    """ Greedy max-diversity selection: starting with the query, repeatedly takes the record with the
+    largest mean Hamming distance to the records taken so far. Returns records in file order. """
+
+    records = list(records)
+    if len(records) <= nseq:
+        return records
+    array = np.stack([np.frombuffer(sequence, dtype=np.uint8) for _, sequence in records])
+    total_distance = np.zeros(len(records))
+    taken = [0]
+    for _ in range(nseq - 1):
+        total_distance += (array != array[taken[-1]]).sum(axis=1)
+        total_distance[taken[-1]] = -np.inf
+        taken.append(int(np.argmax(total_distance)))
+    return [records[index] for index in sorted(taken)]
+
+
+def read_msa(filename: str, nseq: int, strategy: str = "first", max_identity: float = 0.9, max_tokens: int = None) -> List[Tuple[str, str]]:
+    """ Reads up to nseq sequences from an MSA file in a3m format, removing insertions.
+
+    strategy is how the sequences are chosen (the query, first in the file, is always included):
+    * first: the first nseq sequences.
+    * max-identity: the first nseq sequences that are at most max_identity identical to any sequence
+      chosen before them (see max_identity_filter).
+    * diverse: greedy max-diversity selection over the whole MSA (see greedy_diverse).
+    With max_tokens, nseq is lowered so that the MSA has at most max_tokens tokens. """
+
+    records = read_a3m(filename)
+    first = next(records, None)
+    if first is None:
+        raise ValueError(f"No sequences in {filename}")
+    if max_tokens is not None:
+        # One token per aligned column plus BOS
+        nseq = max(1, min(nseq, max_tokens // (len(first[1]) + 1)))
+    records = itertools.chain([first], records)
+
+    if strategy == "first":
+        msa = list(itertools.islice(records, nseq))
+    elif strategy == "max-identity":
+        msa = max_identity_filter(records, nseq, max_identity)
+    elif strategy == "diverse":
+        msa = greedy_diverse(records, nseq)
+    else:
+        raise ValueError(f"Unknown MSA subsampling strategy: {strategy}")
+
+    print(f"Using {len(msa)} sequences of the MSA in {filename} ({strategy})")
+    return [(description, sequence.decode()) for description, sequence in msa]
 
 
 def create_parser():
@@ -51,7 +149,10 @@ def create_parser():
     parser.add_argument(
         "--model-location",
         type=str,
-        help="PyTorch model file OR name of pretrained model to download (see README for models)",
+        help=(
+            "PyTorch model file, converted checkpoint (see checkpoints.py) "
+            "OR name of pretrained model to download (see README for models)"
+        ),
         nargs="+",
     )
     parser.add_argument(
@@ -97,142 +198,371 @@ def create_parser():
         "--msa-samples",
         type=int,
         default=400,
-        help="number of sequences to select from the start of the MSA"
+        help="number of sequences to select from the MSA (see --msa-subsample)"
+    )
+    parser.add_argument(
+        "--msa-subsample",
+        type=str,
+        default="first",
+        choices=["first", "max-identity", "diverse"],
+        help=(
+            "how to select MSA sequences: the first ones in the file, the first ones that are at most "
+            "--msa-max-identity identical to those selected before them, or a greedy max-diversity selection"
+        )
+    )
+    parser.add_argument(
+        "--msa-max-identity",
+        type=float,
+        default=0.9,
+        help="maximum pairwise identity between selected MSA sequences for --msa-subsample max-identity"
+    )
+    parser.add_argument(
+        "--msa-max-tokens",
+        type=int,
+        help="select fewer MSA sequences if needed so that the MSA has at most this many tokens"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=50,
+        help="number of masked sequences (or MSAs) per batch for masked-marginals"
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=50 * 1024,
+        help="token budget (masked sequences x tokens per sequence) per batch for masked-marginals and pseudo-ppl"
+    )
+    parser.add_argument(
+        "--from-store",
+        type=pathlib.Path,
+        nargs="+",
+        help=(
+            "directories of processed predictions ({sequence ID}.tsv.gz or .parquet, from process-results.py) to label "
+            "the scan from; models are only run if the sequence is not found there"
+        )
+    )
+    parser.add_argument(
+        "--sequence-id",
+        type=str,
+        help="ID of --sequence in the --from-store predictions"
+    )
+    parser.add_argument(
+        "--store-sequences",
+        type=pathlib.Path,
+        nargs="+",
+        help="FASTA files of the sequences in --from-store, to find --sequence by its hash when there is no --sequence-id"
     )
     # fmt: on
-    parser.add_argument("--nogpu", action="store_true", help="Do not use GPU even if available")
+    parser.add_argument("--nogpu", action="store_true", help="Do not use GPU even if available (same as --device cpu)")
+    inference.add_arguments(parser)
+    metrics.add_arguments(parser)
     return parser
 
 
-def label_row(row, sequence, token_probs, alphabet, offset_idx):
-    wt, idx, mt = row[0], int(row[1:-1]) - offset_idx, row[-1]
-    assert sequence[idx] == wt, "The listed wildtype does not match the provided sequence"
-
-    wt_encoded, mt_encoded = alphabet.get_idx(wt), alphabet.get_idx(mt)
-
-    # add 1 for BOS
-    score = token_probs[0, 1 + idx, mt_encoded] - token_probs[0, 1 + idx, wt_encoded]
-    return score.item()
-
-
-def compute_pppl(row, sequence, model, alphabet, offset_idx):
-    wt, idx, mt = row[0], int(row[1:-1]) - offset_idx, row[-1]
-    assert sequence[idx] == wt, "The listed wildtype does not match the provided sequence"
+def parse_mutations(mutants: pd.Series, offset_idx: int) -> pd.DataFrame:
+    """ Parses mutation strings 'AiB', or several joined by ':' (e.g. 'A12G:C45T'), for a whole table.
 
-    # modify the sequence
-    sequence = sequence[:idx] + mt + sequence[(idx + 1) :]
+    Returns one row per single mutation, with the row number of its entry in mutants,
+    the wildtype, the 0-based sequence index and the mutant amino acid."""
 
-    # encode the sequence
-    data = [
-        ("protein1", sequence),
-    ]
+    singles = mutants.reset_index(drop=True).astype(str).str.split(":").explode()
+    parts = singles.str.extract(r"^([A-Z])(\d+)([A-Z])$")
 
-    batch_converter = alphabet.get_batch_converter()
+    invalid = parts.isna().any(axis=1)
+    if invalid.any():
+        raise ValueError(
+            f"{invalid.sum()} mutations are not of the form 'AiB' (e.g. A12G): "
+            + ", ".join(singles[invalid].unique()[:10])
+        )
 
-    batch_labels, batch_strs, batch_tokens = batch_converter(data)
+    return pd.DataFrame(
+        {
+            "row": singles.index.to_numpy(),
+            "wt": parts[0].to_numpy(),
+            "idx": parts[1].astype(int).to_numpy() - offset_idx,
+            "mt": parts[2].to_numpy(),
+        }
+    )
 
-    wt_encoded, mt_encoded = alphabet.get_idx(wt), alphabet.get_idx(mt)
 
-    # compute probabilities at each position
-    log_probs = []
-    for i in range(1, len(sequence) - 1):
-        batch_tokens_masked = batch_tokens.clone()
-        batch_tokens_masked[0, i] = alphabet.mask_idx
-        with torch.no_grad():
-            token_probs = torch.log_softmax(model(batch_tokens_masked.cuda())["logits"], dim=-1)
-        log_probs.append(token_probs[0, i, alphabet.get_idx(sequence[i])].item())  # vocab size
-    return sum(log_probs)
+def check_wildtype(mutations: pd.DataFrame, sequence: str, offset_idx: int):
+    """ Checks all mutations against the sequence at once, reporting every mismatch. """
+
+    in_range = (mutations["idx"] >= 0) & (mutations["idx"] < len(sequence))
+    sequence_aa = np.array(list(sequence))[mutations["idx"].where(in_range, 0).to_numpy()]
+    mismatched = ~in_range | (sequence_aa != mutations["wt"].to_numpy())
+    if mismatched.any():
+        report = [
+            f"{wt}{idx + offset_idx}{mt} (sequence has {sequence[idx] if 0 <= idx < len(sequence) else 'no position'})"
+            for wt, idx, mt in mutations.loc[mismatched, ["wt", "idx", "mt"]].itertuples(index=False)
+        ]
+        raise ValueError(
+            f"The listed wildtype does not match the provided sequence for {mismatched.sum()} "
+            f"of {len(mutations)} mutations: " + ", ".join(report[:20]) + (", ..." if len(report) > 20 else "")
+        )
+
+
+def label_mutations(mutations: pd.DataFrame, n_rows: int, token_probs, alphabet) -> np.ndarray:
+    """ Scores each entry as the sum over its mutations of log p(mutant) - log p(wildtype),
+    gathered from token_probs (sequence length x vocabulary, without BOS) in one go. """
+
+    to_idx = np.vectorize(alphabet.get_idx, otypes=[np.int64])
+    token_probs = torch.as_tensor(token_probs)
+    positions = torch.as_tensor(mutations["idx"].to_numpy(), device=token_probs.device)
+    wt_encoded = torch.as_tensor(to_idx(mutations["wt"].to_numpy()), device=token_probs.device)
+    mt_encoded = torch.as_tensor(to_idx(mutations["mt"].to_numpy()), device=token_probs.device)
+
+    scores = (token_probs[positions, mt_encoded] - token_probs[positions, wt_encoded]).cpu().numpy()
+    return np.bincount(mutations["row"].to_numpy(), weights=scores, minlength=n_rows)
+
+
+def masked_marginals(model, alphabet, sequence: str, runtime, batch_size: int, max_tokens: int) -> np.ndarray:
+    """ Masked-marginals scores (sequence length x vocabulary) of an ESM-1v model, from
+    the batched engine of predict_substitutions.py. Batches have at most batch_size
+    masked sequences and max_tokens tokens. """
+
+    batch_size = max(1, min(batch_size, max_tokens // (len(sequence) + 2)))
+    ((_, _, scores),) = run_masked_marginals_model([model], alphabet, [("protein1", sequence)], batch_size, runtime)
+    return scores[0]
+
+
+def msa_masked_marginals(model, alphabet, msa, runtime, batch_size: int, max_tokens: int) -> torch.Tensor:
+    """ Masked-marginals log-probabilities (query length x vocabulary) of an MSA Transformer.
+
+    Each batch holds copies of the MSA with a different position of the query (first)
+    sequence masked, at most batch_size copies and max_tokens tokens. """
+
+    _, _, tokens = alphabet.get_batch_converter()([msa])
+    _, depth, n_tokens = tokens.shape
+    batch_size = max(1, min(batch_size, max_tokens // (depth * n_tokens)))
+
+    token_probs = []
+    # Position 0 is BOS
+    for positions in tqdm(torch.arange(1, n_tokens).split(batch_size)):
+        with metrics.stage("tokenization"):
+            rows = torch.arange(len(positions))
+            tokens_masked = tokens.repeat(len(positions), 1, 1)
+            tokens_masked[rows, 0, positions] = alphabet.mask_idx
+        with metrics.model_batch(
+            runtime.device,
+            strategy="msa-masked-marginals",
+            rows=len(positions),
+            positions=len(positions),
+            padded_tokens=tokens_masked.numel(),
+            real_tokens=tokens_masked.numel(),
+        ):
+            with metrics.stage("host_transfer", runtime.device):
+                tokens_masked = runtime.to_device(tokens_masked)
+            with metrics.stage("forward", runtime.device):
+                batch_probs = score_tokens([model], tokens_masked, runtime, positions.to(tokens_masked.device))[0]
+            with metrics.stage("host_transfer"):
+                token_probs.append(batch_probs.cpu())
+    return torch.cat(token_probs)
+
+
+def find_stored(store_dirs, sequence: str, sequence_id: str = None, store_sequences=None):
+    """ Finds the processed predictions for the sequence, by ID or by its hash among store_sequences.
+
+    Returns the sequence ID, the path and the stored predictions (indexed by HGVS), or None if there
+    are none whose reference amino acids match the sequence. """
+
+    candidates = []
+    if sequence_id is not None:
+        candidates.append(sequence_id)
+    if store_sequences:
+        sequence_hash = window_hash(sequence)
+        candidates += [
+            record.id
+            for path in store_sequences
+            for record in read_sequences(path)
+            if len(record) == len(sequence) and window_hash(str(record.seq)) == sequence_hash
+        ]
+
+    for candidate in candidates:
+        for store_dir, suffix in itertools.product(store_dirs, PROCESSED_SUFFIXES):
+            path = store_dir / f"{candidate}{suffix}"
+            if not path.exists():
+                continue
+            if suffix == ".parquet":
+                stored = pd.read_parquet(path)
+            else:
+                stored = pd.read_csv(path, sep="\t", index_col="HGVS")
+            # Check the stored reference amino acids against the sequence
+            refs = stored.index.str.extract(r"p\.([A-Z][a-z]{2})(\d+)[A-Z][a-z]{2}$").drop_duplicates(1)
+            stored_sequence = pd.Series(refs[0].to_numpy(), index=refs[1].astype(int).to_numpy()).sort_index()
+            expected = [AA_NAMES.get(aa) for aa in sequence]
+            if stored_sequence.index.tolist() == list(range(1, len(sequence) + 1)) and stored_sequence.tolist() == expected:
+                return candidate, path, stored
+            print(f"Skipping {path}: its reference sequence does not match --sequence")
+    return None
+
+
+def label_from_store(stored: pd.DataFrame, sequence_id: str, mutations: pd.DataFrame, n_rows: int) -> pd.DataFrame:
+    """ Joins the per-model and combined scores of stored predictions to each entry, summing over its mutations.
+
+    Scores are taken relative to the stored score of the wildtype at the same position, which makes
+    no difference for masked-marginals predictions (where that is 0) and gives the usual
+    log p(mutant) - log p(wildtype) for wt-marginals predictions. """
+
+    prefix = sequence_id + ":p." + mutations["wt"].map(AA_NAMES) + (mutations["idx"] + 1).astype(str)
+    hgvs = prefix + mutations["mt"].map(AA_NAMES)
+    columns = [column for column in stored.columns if not column.endswith("_next")]
+    scores = stored[columns].reindex(hgvs.to_numpy())
+    scores -= stored[columns].reindex((prefix + mutations["wt"].map(AA_NAMES)).to_numpy()).to_numpy()
+
+    missing = scores.isna().all(axis=1).to_numpy()
+    if missing.any():
+        print(f"{missing.sum()} mutations are not in the stored predictions: " + ", ".join(hgvs[missing].unique()[:10]))
+
+    return scores.groupby(mutations["row"].to_numpy()).sum(min_count=1).reindex(range(n_rows))
+
+
+def mutate_sequences(mutations: pd.DataFrame, n_rows: int, sequence: str) -> np.ndarray:
+    """ Applies the mutations of each of n_rows entries to the sequence, returning an array of mutated sequences. """
+
+    mutated = np.tile(np.array(list(sequence)), (n_rows, 1))
+    mutated[mutations["row"].to_numpy(), mutations["idx"].to_numpy()] = mutations["mt"].to_numpy()
+    return np.array(["".join(row) for row in mutated])
+
+
+def compute_pppl(sequences, model, alphabet, runtime, max_tokens: int) -> np.ndarray:
+    """ Pseudo-log-likelihood of each sequence: the sum over positions of the log-probability
+    of the sequence's token with that position masked.
+
+    Masked copies (one per position of each sequence) are run in batches of at most max_tokens
+    tokens, packing copies of several sequences into each batch. Repeated sequences, whose
+    masked copies would be identical, are scored once. """
+
+    unique_sequences, inverse = np.unique(sequences, return_inverse=True)
+    _, _, tokens = alphabet.get_batch_converter()([("", str(seq)) for seq in unique_sequences])
+    n_sequences, n_tokens = tokens.shape
+    length = n_tokens - 2
+
+    # Masked copies are numbered n * length + i for sequence n with position i masked
+    n_copies = n_sequences * length
+    batch_rows = max(1, max_tokens // n_tokens)
+    log_probs = torch.zeros(n_sequences, dtype=torch.float64)
+
+    start_time = time.perf_counter()
+    for batch_start in tqdm(range(0, n_copies, batch_rows), unit="batch"):
+        copies = torch.arange(batch_start, min(batch_start + batch_rows, n_copies))
+        rows = torch.arange(len(copies))
+        seq_index = copies // length
+        positions = copies % length + 1  # add 1 for BOS
+
+        with metrics.stage("tokenization"):
+            tokens_masked = tokens[seq_index]
+            true_tokens = tokens_masked[rows, positions]
+            tokens_masked[rows, positions] = alphabet.mask_idx
+
+        with metrics.model_batch(
+            runtime.device,
+            strategy="pseudo-ppl",
+            rows=len(copies),
+            positions=len(copies),
+            padded_tokens=tokens_masked.numel(),
+            real_tokens=tokens_masked.numel(),
+        ):
+            with metrics.stage("host_transfer", runtime.device):
+                tokens_masked = runtime.to_device(tokens_masked)
+            with metrics.stage("forward", runtime.device), torch.no_grad(), runtime.autocast():
+                logits = model(tokens_masked)["logits"]
+                token_probs = torch.log_softmax(logits[rows, positions.to(logits.device)].float(), dim=-1)
+            with metrics.stage("host_transfer"):
+                token_probs = token_probs.cpu()
+        log_probs.index_add_(0, seq_index, token_probs[rows, true_tokens].double())
+
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"Scored {n_copies} masked positions of {n_sequences} unique sequences ({len(sequences)} entries) "
+        f"in {elapsed:.1f} s ({n_copies / elapsed:.1f} positions/sec)"
+    )
+    return log_probs.numpy()[inverse]
 
 
 def main(args):
-    # Load the deep mutational scan
-    df = pd.read_csv(args.dms_input)
-
-    # inference for each model
-    for model_location in args.model_location:
-        model, alphabet = pretrained.load_model_and_alphabet(model_location)
-        model.eval()
-        if torch.cuda.is_available() and not args.nogpu:
-            model = model.cuda()
-            print("Transferred model to GPU")
-
-        batch_converter = alphabet.get_batch_converter()
-
-        if isinstance(model, MSATransformer):
-            data = [read_msa(args.msa_path, args.msa_samples)]
-            assert (
-                args.scoring_strategy == "masked-marginals"
-            ), "MSA Transformer only supports masked marginal strategy"
-
-            batch_labels, batch_strs, batch_tokens = batch_converter(data)
-
-            all_token_probs = []
-            for i in tqdm(range(batch_tokens.size(2))):
-                batch_tokens_masked = batch_tokens.clone()
-                batch_tokens_masked[0, 0, i] = alphabet.mask_idx  # mask out first sequence
-                with torch.no_grad():
-                    token_probs = torch.log_softmax(
-                        model(batch_tokens_masked.cuda())["logits"], dim=-1
+    if args.nogpu:
+        args.device = "cpu"
+    runtime = inference.Runtime.from_args(args)
+    metrics.configure(args.metrics, args.profile_batch, script="predict", args=vars(args), runtime=str(runtime))
+
+    with metrics.recorder:
+        # Load the deep mutational scan
+        df = pd.read_csv(args.dms_input)
+        mutations = parse_mutations(df[args.mutation_col], args.offset_idx)
+        check_wildtype(mutations, args.sequence, args.offset_idx)
+
+        if args.from_store:
+            found = find_stored(args.from_store, args.sequence, args.sequence_id, args.store_sequences)
+            if found is not None:
+                stored_id, path, stored = found
+                print(f"Labeling from stored predictions in {path}")
+                with metrics.stage("assembly"):
+                    scores = label_from_store(stored, stored_id, mutations, len(df))
+                    for column in scores.columns:
+                        df[column] = scores[column].to_numpy()
+                with metrics.stage("write"):
+                    df.to_csv(args.dms_output)
+                return
+            print("The sequence is not in the stored predictions, running the models")
+
+        if not args.model_location:
+            raise ValueError("No --model-location to run")
+
+        # inference for each model
+        for model_location in args.model_location:
+            start_time = time.perf_counter()
+            with metrics.stage("model_load", runtime.device):
+                model, alphabet = checkpoints.load_model_and_alphabet(model_location)
+                model = runtime.prepare(model)
+            metrics.record("model_load", model=model_location, seconds=time.perf_counter() - start_time)
+            print(f"Running model on {runtime}")
+
+            if isinstance(model, MSATransformer):
+                with metrics.stage("msa_read"):
+                    msa = read_msa(
+                        args.msa_path, args.msa_samples, args.msa_subsample, args.msa_max_identity, args.msa_max_tokens
+                    )
+                assert (
+                    args.scoring_strategy == "masked-marginals"
+                ), "MSA Transformer only supports masked marginal strategy"
+
+                token_probs = msa_masked_marginals(model, alphabet, msa, runtime, args.batch_size, args.max_tokens)
+                with metrics.stage("assembly"):
+                    df[model_location] = label_mutations(mutations, len(df), token_probs, alphabet)
+
+            else:
+                if args.scoring_strategy == "wt-marginals":
+                    batch_converter = alphabet.get_batch_converter()
+                    batch_labels, batch_strs, batch_tokens = batch_converter([("protein1", args.sequence)])
+                    with metrics.model_batch(
+                        runtime.device,
+                        strategy="wt-marginals",
+                        rows=1,
+                        positions=len(args.sequence),
+                        padded_tokens=batch_tokens.numel(),
+                        real_tokens=batch_tokens.numel(),
+                    ):
+                        with metrics.stage("host_transfer", runtime.device):
+                            batch_tokens = runtime.to_device(batch_tokens)
+                        with metrics.stage("forward", runtime.device):
+                            token_probs = score_tokens([model], batch_tokens, runtime)[0, 0, 1:-1]
+                    with metrics.stage("assembly"):
+                        df[model_location] = label_mutations(mutations, len(df), token_probs, alphabet)
+                elif args.scoring_strategy == "masked-marginals":
+                    token_probs = masked_marginals(
+                        model, alphabet, args.sequence, runtime, args.batch_size, args.max_tokens
+                    )
+                    with metrics.stage("assembly"):
+                        df[model_location] = label_mutations(mutations, len(df), token_probs, alphabet)
+                elif args.scoring_strategy == "pseudo-ppl":
+                    df[model_location] = compute_pppl(
+                        mutate_sequences(mutations, len(df), args.sequence), model, alphabet, runtime, args.max_tokens
                     )
-                all_token_probs.append(token_probs[:, 0, i])  # vocab size
-            token_probs = torch.cat(all_token_probs, dim=0).unsqueeze(0)
-            df[model_location] = df.apply(
-                lambda row: label_row(
-                    row[args.mutation_col], args.sequence, token_probs, alphabet, args.offset_idx
-                ),
-                axis=1,
-            )
 
-        else:
-            data = [
-                ("protein1", args.sequence),
-            ]
-            batch_labels, batch_strs, batch_tokens = batch_converter(data)
-
-            if args.scoring_strategy == "wt-marginals":
-                with torch.no_grad():
-                    token_probs = torch.log_softmax(model(batch_tokens.cuda())["logits"], dim=-1)
-                df[model_location] = df.apply(
-                    lambda row: label_row(
-                        row[args.mutation_col],
-                        args.sequence,
-                        token_probs,
-                        alphabet,
-                        args.offset_idx,
-                    ),
-                    axis=1,
-                )
-            elif args.scoring_strategy == "masked-marginals":
-                all_token_probs = []
-                for i in tqdm(range(batch_tokens.size(1))):
-                    batch_tokens_masked = batch_tokens.clone()
-                    batch_tokens_masked[0, i] = alphabet.mask_idx
-                    with torch.no_grad():
-                        token_probs = torch.log_softmax(
-                            model(batch_tokens_masked.cuda())["logits"], dim=-1
-                        )
-                    all_token_probs.append(token_probs[:, i])  # vocab size
-                token_probs = torch.cat(all_token_probs, dim=0).unsqueeze(0)
-                df[model_location] = df.apply(
-                    lambda row: label_row(
-                        row[args.mutation_col],
-                        args.sequence,
-                        token_probs,
-                        alphabet,
-                        args.offset_idx,
-                    ),
-                    axis=1,
-                )
-            elif args.scoring_strategy == "pseudo-ppl":
-                tqdm.pandas()
-                df[model_location] = df.progress_apply(
-                    lambda row: compute_pppl(
-                        row[args.mutation_col], args.sequence, model, alphabet, args.offset_idx
-                    ),
-                    axis=1,
-                )
-
-    df.to_csv(args.dms_output)
+        with metrics.stage("write"):
+            df.to_csv(args.dms_output)
 
 
 if __name__ == "__main__":
@@ -1,24 +1,62 @@
 """Generate ESM-1v predictions for every amino acid substitution in a collection of sequences."""
 
+from abc import ABC, abstractmethod
 from argparse import ArgumentParser
 from pathlib import Path
 import gzip
+import hashlib
+import os
+import re
+import socket
+import struct
+import zipfile
+import zlib
 from timeit import default_timer
 from collections import defaultdict
+from contextlib import nullcontext
+from functools import partial
+from itertools import chain
+from threading import Thread
+import queue
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from Bio import SeqIO
 import torch
-from esm import pretrained
+from esm import Alphabet
 
-# ESM-1v models won't handle sequences longer than 1024.
-# Accounting for the start and end tokens this leaves 1022 AAs.
-# To process larger proteins, we break up the sequences into chunks of 1022
-# AAs, but we maintain an overlap between consecutive chunks to eliminate
-# start-of-sequence and end-of-sequence biases.
-MAX_SEQ_LENTH = 1022
-SEQ_OVERLAP = 100
+import checkpoints
+import inference
+import metrics
+# Sequences are scored in overlapping windows of at most MAX_SEQ_LENTH AAs (see windowing.py)
+from windowing import MAX_SEQ_LENTH, windows
+
+# Masked-marginals batches pack rows from chunks whose lengths fall in the same
+# bucket of this width, looking ahead this many batches worth of positions.
+LENGTH_BUCKET_WIDTH = 64
+PACKING_LOOKAHEAD = 256
+# Wt-marginals batches are formed from length-sorted chunks, looking ahead this
+# many token budgets worth of positions.
+SORTING_LOOKAHEAD = 16
+
+# Records with an ID of this form and a matching length are single windows
+# (e.g. from plan-missing-work.py) and are scored as they are.
+WINDOW_ID = re.compile(r'.+\[(\d+):(\d+)\]')
+
+# Number of batches built ahead of the one running on the model
+PREFETCH_DEPTH = 2
+
+# Fraction of the memory limit that probed batches may take (see probe_max_tokens),
+# leaving room for fragmentation and for batches that pad differently
+PROBE_HEADROOM = 0.9
+
+# Amino acid tokens kept in compact output formats.
+# This is the order of the ESM-1v vocabulary, excluding XBZ and special tokens.
+AA_TOKENS = 'LAGVSERTIDPKQNFYMHWCUO'
+
+# Name of the mean over models in ensemble outputs
+ENSEMBLE_MEAN = 'ensemble_mean'
 
 def create_parser():
     parser = ArgumentParser(
@@ -28,7 +66,10 @@ def create_parser():
     parser.add_argument(
         '--model-location',
         type=str,
-        help='PyTorch model file OR name of pretrained model to download',
+        help=(
+            'PyTorch model file, converted checkpoint ({model name}.safetensors, see checkpoints.py) '
+            'OR name of pretrained model to download'
+        ),
         nargs='+'
     )
 
@@ -41,7 +82,7 @@ def create_parser():
     parser.add_argument(
         '--results',
         type=Path,
-        help='Output file to which to write CSV-formatted results.'
+        help='Output file to which to write results (see --format).'
     )
 
     parser.add_argument(
@@ -58,209 +99,1096 @@ def create_parser():
         default=50,
         help=(
             'Batch size for prediction. '
-            'If GPU memory use becomes an issue, setting this lower may help.'
+            'Batches that run out of memory are split and retried, see BatchLimits.'
+        )
+    )
+
+    parser.add_argument(
+        '--max-tokens',
+        type=int,
+        help=(
+            'Token budget (sequences x padded length) per batch for the wt-marginals strategy. '
+            f'Defaults to the batch size times {MAX_SEQ_LENTH + 2}, i.e. a batch of the longest chunks.'
+        )
+    )
+
+    parser.add_argument(
+        '--auto-batch-size',
+        action='store_true',
+        help=(
+            'On a GPU, probe the largest batch (rows x padded length) that fits in memory at startup, '
+            'by running batches of full-length chunks through the models, and use it in place of '
+            '--batch-size and --max-tokens, so batches of shorter chunks get more rows. See probe_max_tokens.'
+        )
+    )
+
+    parser.add_argument(
+        '--memory-limit',
+        type=float,
+        help=(
+            'GPU memory in GB that the job may use. Allocations beyond it fail, '
+            "and are handled like the device running out of memory. Defaults to the device's memory."
+        )
+    )
+
+    parser.add_argument(
+        '--ensemble',
+        action='store_true',
+        help=(
+            'Load all --model-location models at once and run each batch through every model, '
+            'so that sequences are chunked, tokenized and batched only once. '
+            'Results hold every model and their mean (see CsvResultWriter and NpzResultWriter).'
+        )
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help=(
+            'Continue from an earlier run that wrote to the same --results, '
+            'skipping chunks recorded as complete in its progress manifest ({results}.progress).'
         )
     )
 
+    parser.add_argument(
+        '--format',
+        type=str,
+        default='csv',
+        choices=['csv', 'npz'],
+        help=(
+            'Output format. '
+            'csv: one row per position with a column for every vocabulary token. '
+            'npz: a zip of .npy arrays, one (positions x amino acids) array per chunk and model, '
+            'see NpzResultWriter.'
+        )
+    )
+
+    parser.add_argument(
+        '--precision',
+        type=str,
+        default='float32',
+        choices=['float32', 'float16'],
+        help='Floating point precision of scores in the npz format.'
+    )
+
+    parser.add_argument(
+        '--cache',
+        type=Path,
+        help=(
+            'Directory of a prediction cache, keyed by model checksum, scoring strategy and window sequence. '
+            'Windows found in the cache are not scored again, and newly scored windows are added to it. '
+            'See PredictionCache.'
+        )
+    )
+
+    inference.add_arguments(parser)
+    metrics.add_arguments(parser)
+
     return parser
 
 
+def read_sequences(path):
+    """Yield sequence records from a (possibly gzipped) FASTA file as it is read."""
+
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rt') as in_handle:
+        yield from SeqIO.parse(in_handle, 'fasta')
+
+
 def chunk_sequences(seq_list):
-    chunk_list = []
+    """Yield (chunk ID, chunk sequence) for the windows of each sequence.
+
+    Records that are already windows, with a chunk ID (see WINDOW_ID), are passed through.
+    """
+
     for seq in seq_list:
-        remainder = seq.seq
-        index = 0
-        while remainder:
-            chunk_len = min(len(remainder), MAX_SEQ_LENTH)
-            chunk_list.append(
-                (f'{seq.id}[{index}:{index+chunk_len}]', remainder[0:chunk_len])
-            )
-            if len(remainder) > MAX_SEQ_LENTH:
-                remainder = remainder[(MAX_SEQ_LENTH - SEQ_OVERLAP):]
-                index += MAX_SEQ_LENTH - SEQ_OVERLAP
-            else:
-                remainder = None
-    return chunk_list
+        window = WINDOW_ID.fullmatch(seq.id)
+        if window and int(window[2]) - int(window[1]) == len(seq) <= MAX_SEQ_LENTH:
+            yield seq.id, str(seq.seq)
+            continue
+
+        for start, end in windows(len(seq)):
+            yield f'{seq.id}[{start}:{end}]', str(seq.seq[start:end])
 
 
-def run_wt_marginals_model(model_location, chunk_list, batch_size):
+def prefetch(iterable, depth=PREFETCH_DEPTH):
+    """Iterate over iterable in a background thread, keeping up to depth items ready.
+
+    This lets the CPU-side work of building batches overlap with model compute.
+    Exceptions raised while iterating are re-raised in the consuming thread.
+    """
+
+    items = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+            items.put(done)
+        except BaseException as e:
+            items.put(e)
+
+    Thread(target=produce, daemon=True).start()
+
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def get_model_name(model_location):
+    is_file = model_location.endswith('.pt') or checkpoints.is_checkpoint(model_location)
+    return Path(model_location).stem if is_file else model_location
+
+
+def load_model(model_location, runtime):
+    """Load a model and its alphabet, preparing the model for the runtime's device and precision."""
+
+    start_time = default_timer()
+    print(f'Loading model {model_location}')
+
+    with metrics.stage('model_load', runtime.device):
+        model, alphabet = checkpoints.load_model_and_alphabet(model_location)
+        model = runtime.prepare(model)
+    print(f'Running model on {runtime}')
+
+    elapsed = default_timer() - start_time
+    print(f'It took {elapsed} seconds to load the model.')
+    metrics.record('model_load', model=model_location, seconds=elapsed)
+
+    return model, alphabet
+
+
+def score_tokens(models, batch_tokens, runtime, positions=None):
+    """Run a batch through each model in turn.
+
+    Returns a (models x batch x sequence x vocabulary) tensor of float32 log-probabilities.
+    With positions, a tensor holding one token position per batch row, only the
+    log-probabilities at those positions are computed, giving a
+    (models x batch x vocabulary) tensor. For batches of MSAs
+    (batch x alignment depth x sequence), as the MSA Transformer takes, these are
+    positions in the first (query) sequence of each alignment.
+    """
+
+    with torch.no_grad():
+        logits = []
+        for model in models:
+            with runtime.autocast():
+                model_logits = model(batch_tokens)['logits']
+            if positions is not None:
+                if model_logits.dim() == 4:
+                    model_logits = model_logits[:, 0]
+                model_logits = model_logits[torch.arange(len(positions)), positions]
+            logits.append(model_logits)
+        return torch.log_softmax(torch.stack(logits).float(), dim=-1)
+
+
+def is_out_of_memory(error):
+    """Whether an exception is a failed allocation, on the GPU or reported by the CPU allocator"""
+
+    return isinstance(error, torch.cuda.OutOfMemoryError) or (
+        isinstance(error, RuntimeError) and ('out of memory' in str(error) or "can't allocate memory" in str(error))
+    )
+
+
+class BatchLimits:
+    """Largest batches known to fit in memory, learned from batches that ran out of memory.
+
+    A batch that runs out of memory is split in half and retried (see
+    score_batch), and the rows that the half has become the limit for its
+    bucket of padded length (LENGTH_BUCKET_WIDTH wide), and for longer ones.
+    Later batches in those buckets are run in parts of at most that many rows.
+    max_tokens is the token budget probed at startup (see probe_max_tokens),
+    that batches are planned with in place of the batch size options.
+    """
+
+    def __init__(self, max_tokens=None):
+        self.max_tokens = max_tokens
+        self.rows = {}
+
+    def max_rows(self, length):
+        """Largest number of rows of padded length known to fit, or None"""
+
+        bucket = length // LENGTH_BUCKET_WIDTH
+        limits = [rows for limit_bucket, rows in self.rows.items() if limit_bucket <= bucket]
+        return min(limits) if limits else None
+
+    def lower(self, length, rows):
+        """Record that a batch of rows of padded length ran out of memory"""
+
+        bucket = length // LENGTH_BUCKET_WIDTH
+        self.rows[bucket] = min(self.rows.get(bucket, rows), max(1, rows // 2))
+        print(
+            f'A batch of {rows} rows of length {length} ran out of memory, '
+            f'splitting batches of this length and longer into parts of {self.rows[bucket]} rows.'
+        )
+        metrics.count(oom_splits=1)
+        metrics.record('oom', padded_length=length, rows=rows, limit=self.rows[bucket])
+
+
+def score_batch(models, batch_tokens, runtime, limits, positions=None):
+    """score_tokens, running the batch in parts of at most the rows that limits (a BatchLimits) allow.
+
+    A part that runs out of memory is split in half and retried, and the
+    limit is lowered for later batches. A single row that does not fit is an error.
+    """
+
+    length = batch_tokens.shape[-1]
+    scores = []
+    start = 0
+    while start < len(batch_tokens):
+        end = min(start + (limits.max_rows(length) or len(batch_tokens)), len(batch_tokens))
+        try:
+            scores.append(score_tokens(
+                models, batch_tokens[start:end], runtime, None if positions is None else positions[start:end]
+            ))
+            start = end
+            continue
+        except RuntimeError as e:
+            if not is_out_of_memory(e) or end - start == 1:
+                raise
+        # Release what the failed attempt allocated, now that its traceback is gone
+        if runtime.device.type == 'cuda':
+            torch.cuda.empty_cache()
+        limits.lower(length, end - start)
+
+    return scores[0] if len(scores) == 1 else torch.cat(scores, dim=1)
+
+
+def probe_max_tokens(models, alphabet, runtime, memory_limit=None, masked=True):
+    """Probe the token budget (rows x padded length) of the largest batch of full-length chunks that fits on a GPU.
+
+    Batches of random full-length chunks are run through the models, doubling
+    the rows until a batch runs out of memory or would take more than
+    PROBE_HEADROOM of the memory available (at most memory_limit bytes). The
+    rows are then extrapolated from the peak memory of the largest batch that
+    fit, since memory use grows linearly with rows, and checked with one more
+    batch. Shorter chunks take less memory per token (attention is quadratic
+    in length), so the budget holds for them too. With masked, only the
+    log-probabilities at one position per row are computed, as in masked-marginals.
+    Returns None on the CPU, where allocations beyond memory are not reliably
+    reported as errors.
+    """
+
+    if runtime.device.type != 'cuda':
+        print('Batch sizes are only probed on GPUs, using --batch-size and --max-tokens.')
+        return None
 
     start_time = default_timer()
-    print('Loading model')
+    device = runtime.device
+    free, total = torch.cuda.mem_get_info(device)
+    available = min(memory_limit or total, free + torch.cuda.memory_reserved(device))
+    budget = PROBE_HEADROOM * available
+    base = torch.cuda.memory_allocated(device)
+
+    length = MAX_SEQ_LENTH + 2
+    aa_indices = torch.tensor([alphabet.get_idx(aa) for aa in AA_TOKENS[:20]])
+    generator = torch.Generator().manual_seed(0)
+
+    def peak_memory(rows):
+        """Peak memory of scoring a batch of rows, or None if it runs out of memory"""
+        tokens = aa_indices[torch.randint(len(aa_indices), (rows, length), generator=generator)]
+        tokens[:, 0] = alphabet.cls_idx
+        tokens[:, -1] = alphabet.eos_idx
+        positions = torch.ones(rows, dtype=torch.long, device=device) if masked else None
+        torch.cuda.reset_peak_memory_stats(device)
+        try:
+            score_tokens(models, runtime.to_device(tokens), runtime, positions)
+            torch.cuda.synchronize(device)
+            return torch.cuda.max_memory_allocated(device)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+        torch.cuda.empty_cache()
+        return None
+
+    fitted, fitted_peak, rows = 0, None, 1
+    while (peak := peak_memory(rows)) is not None and peak <= budget:
+        fitted, fitted_peak = rows, peak
+        rows *= 2
+    if not fitted:
+        print(f'A single full-length chunk does not fit in {budget / 2**30:.1f} GB, using --batch-size and --max-tokens.')
+        return None
+
+    # Extrapolate between the largest batch that fit and the smallest that did not
+    estimate = min(rows - 1, int(fitted * (budget - base) / max(fitted_peak - base, 1)))
+    if estimate > fitted and ((peak := peak_memory(estimate)) is not None and peak <= budget):
+        fitted = estimate
+    torch.cuda.empty_cache()
+
+    max_tokens = fitted * length
+    elapsed = default_timer() - start_time
+    print(
+        f'Batches of up to {fitted} full-length chunks ({max_tokens} tokens) fit in {budget / 2**30:.1f} GB; '
+        f'it took {elapsed} seconds to probe.'
+    )
+    metrics.record('probe', rows=fitted, max_tokens=max_tokens, budget_bytes=budget, seconds=elapsed)
+    return max_tokens
+
+
+def group_chunks(chunks, group_rows):
+    """Split chunks into consecutive groups of about group_rows positions (the packing lookahead)."""
+
+    group = []
+    rows = 0
+    for chunk in chunks:
+        group.append(chunk)
+        rows += len(chunk[1])
+        if rows >= group_rows:
+            yield group
+            group = []
+            rows = 0
+    if group:
+        yield group
+
+
+def plan_token_batches(chunks, max_tokens):
+    """Plan batches of whole sequence chunks under a token budget.
 
-    # Get model name
-    model_name = Path(model_location).stem if model_location.endswith('.pt') else model_location
+    Given that chunks is a list of tuples (id, sequence),
+    return a list of batches, each a list of chunk indices, such that the
+    padded size of each batch (number of chunks x longest chunk, counting the
+    start and end tokens) is at most max_tokens. A chunk that exceeds the budget
+    on its own gets a batch to itself.
+    Chunks are sorted by length so that chunks of similar length share a batch.
+    """
+
+    batches = []
+    batch = []
+    for index in sorted(range(len(chunks)), key=lambda index: len(chunks[index][1])):
+        padded_length = len(chunks[index][1]) + 2
+        if batch and (len(batch) + 1) * padded_length > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
 
-    # Load model
-    model, alphabet = pretrained.load_model_and_alphabet(model_location)
-    model.eval()
+    return batches
 
-    if torch.cuda.is_available():
-        model = model.cuda()
-        print("Transferred model to GPU")
 
-    print(f'It took {default_timer() - start_time} seconds to load the model.')
+def prepare_token_batches(chunks, alphabet, max_tokens, runtime):
+    """Yield (group, batch, batch_strs, batch_tokens) for each wt-marginals batch.
+
+    Batches are planned with plan_token_batches within groups of
+    SORTING_LOOKAHEAD token budgets. batch holds indices into group.
+    """
 
     batch_converter = alphabet.get_batch_converter()
 
-    results = []
-    chunks_left = chunk_list
-    while chunks_left:
+    for group in group_chunks(chunks, SORTING_LOOKAHEAD * max_tokens):
+        with metrics.stage('tokenization'):
+            batches = plan_token_batches(group, max_tokens)
+        for batch in batches:
+            with metrics.stage('tokenization'):
+                _, batch_strs, batch_tokens = batch_converter([group[index] for index in batch])
+                batch_tokens = runtime.pin(batch_tokens)
+            yield group, batch, batch_strs, batch_tokens
+
+
+def run_wt_marginals_model(models, alphabet, chunks, max_tokens, runtime, limits=None):
+    """Score chunks with the wt-marginals strategy.
+
+    Each batch is tokenized once and run through every model in `models`.
+    Batches are built in the background (see prepare_token_batches), and
+    results are yielded in the original chunk order. limits is a BatchLimits,
+    whose probed token budget, if any, replaces max_tokens.
+    Yields (chunk ID, chunk sequence, scores) where scores is a
+    (models x chunk length x vocabulary size) array of log-probabilities.
+    """
+
+    limits = limits or BatchLimits()
+    max_tokens = limits.max_tokens or max_tokens
+    current_group = None
+    for group, batch, batch_strs, batch_tokens in prefetch(prepare_token_batches(chunks, alphabet, max_tokens, runtime)):
         start_time = default_timer()
-        processed_chunks = chunks_left[:batch_size]
-        chunks_left = chunks_left[batch_size:]
 
-        batch_labels, batch_strs, batch_tokens = batch_converter(processed_chunks)
+        if group is not current_group:
+            current_group = group
+            group_scores = [None] * len(group)
+            next_index = 0
 
         # Using the marginals scoring strategy
-        with torch.no_grad():
-            token_probs = torch.log_softmax(model(batch_tokens.cuda())['logits'], dim=-1)
-
-        # Put results in a dataframe
-        results.append(
-            pd.DataFrame.from_records(
-                [
-                    [label, a, aa] + token_probs[b, a+1, :].tolist()
-                    for b, label in enumerate(batch_labels)
-                    for a, aa in enumerate(batch_strs[b])
-                ],
-                columns=['chunk', 'pos', 'ref'] + alphabet.all_toks,
-                index = ['chunk', 'pos']
-            )
-        )
+        with metrics.model_batch(
+            runtime.device,
+            strategy='wt-marginals',
+            rows=len(batch),
+            positions=sum(len(chunk_seq) for chunk_seq in batch_strs),
+            padded_tokens=batch_tokens.numel(),
+            real_tokens=sum(len(chunk_seq) + 2 for chunk_seq in batch_strs),
+            chunks=[[group[index][0], len(group[index][1])] for index in batch]
+        ):
+            with metrics.stage('host_transfer', runtime.device):
+                batch_tokens = runtime.to_device(batch_tokens)
+            with metrics.stage('forward', runtime.device):
+                token_probs = score_batch(models, batch_tokens, runtime, limits)
+            with metrics.stage('host_transfer'):
+                token_probs = token_probs.cpu().numpy()
+
+        for b, index in enumerate(batch):
+            # +1 because of the start token
+            group_scores[index] = token_probs[:, b, 1:len(batch_strs[b]) + 1, :]
 
         print(
             f'It took {default_timer() - start_time} seconds '
-            f'to process {len(batch_labels)} sequence chunks.'
+            f'to process {len(batch)} sequence chunks.'
         )
 
-    result = pd.concat(results)
-    result['model'] = model_name
-    result.set_index('model', append=True)
+        # Hand over chunks as soon as they and all chunks before them are done
+        while next_index < len(group) and group_scores[next_index] is not None:
+            chunk_id, chunk_seq = group[next_index]
+            yield chunk_id, chunk_seq, group_scores[next_index]
+            group_scores[next_index] = False
+            next_index += 1
 
-    return result
 
+def plan_masked_batches(chunks, batch_size, bucket_width=LENGTH_BUCKET_WIDTH, max_tokens=None):
+    """Plan batches of masked rows for a group of sequence chunks.
+
+    Given that chunks is a list of tuples (id, sequence),
+    return a list of batches, each a list of tuples (chunk index, start, end)
+    where start and end are slice ends of the positions to mask in that chunk.
+    Every batch has at most batch_size rows, and rows from several chunks are
+    packed into the same batch when the chunks fall in the same length bucket,
+    so that short sequences fill batches while padding stays below bucket_width.
+    With max_tokens, batches instead have as many rows as fit in max_tokens
+    tokens at the padded length of the longest chunk in their bucket.
+    """
+
+    # Buckets are taken in order of their first chunk, so that chunks complete roughly in order
+    buckets = defaultdict(list)
+    for index, (_, chunk_seq) in enumerate(chunks):
+        buckets[len(chunk_seq) // bucket_width].append(index)
 
-def mask_token_tensor(token_sequence, alphabet, position):
-    result = token_sequence.clone()
-    result[0, position] = alphabet.mask_idx
-    return result
+    batches = []
+    for bucket in buckets:
+        bucket_rows = batch_size
+        if max_tokens is not None:
+            bucket_rows = max(1, max_tokens // (max(len(chunks[index][1]) for index in buckets[bucket]) + 2))
+        batch = []
+        rows = 0
+        for index in buckets[bucket]:
+            start = 0
+            seq_end = len(chunks[index][1])
+            while start < seq_end:
+                end = min(start + bucket_rows - rows, seq_end)
+                batch.append((index, start, end))
+                rows += end - start
+                start = end
+                if rows == bucket_rows:
+                    batches.append(batch)
+                    batch = []
+                    rows = 0
+        if batch:
+            batches.append(batch)
 
+    return batches
 
-def split_to_batches(chunks, batch_size):
-    """Split a list of sequence chunks to batches:
 
-    Given that chunks is an iterable of tuples (id, sequence),
-    return a list of tuples (id, sequence, start, end)
-    where start and end define slice ends, i.e.
-    they are integer indeces such that end - start <= batch_size
-    and each sequence is fully covered by intervals.
+def prepare_masked_batches(chunks, alphabet, batch_size, runtime, max_tokens=None):
+    """Yield (group, batch, tokens_masked, row_pos, wt_tokens) for each masked-marginals batch.
+
+    Batches are planned with plan_masked_batches (with max_tokens, if given)
+    within groups of PACKING_LOOKAHEAD batches. tokens_masked has one row per
+    masked position, row_pos holds the masked token position of each row, and
+    wt_tokens the original token at that position.
     """
 
-    result = []
-    for chunk_id, chunk_seq in chunks:
-        start = 0
-        seq_end = len(chunk_seq)
-        while start < seq_end:
-            end = min(start + batch_size, seq_end)
-            result.append((chunk_id, chunk_seq, start, end))
-            start = end
+    batch_converter = alphabet.get_batch_converter()
+    group_rows = PACKING_LOOKAHEAD * (batch_size if max_tokens is None else max(1, max_tokens // (MAX_SEQ_LENTH + 2)))
 
-    return result
+    for group in group_chunks(chunks, group_rows):
+        with metrics.stage('tokenization'):
+            batches = plan_masked_batches(group, batch_size, max_tokens=max_tokens)
+        for batch in batches:
+            with metrics.stage('tokenization'):
+                # Tokenize the chunks in this batch, padded to the longest of them
+                chunk_indices = sorted({index for index, _, _ in batch})
+                _, _, batch_tokens = batch_converter([group[index] for index in chunk_indices])
+                token_row = {index: row for row, index in enumerate(chunk_indices)}
 
+                # Make masked matrix: one row per masked position
+                row_chunk = torch.tensor([token_row[index] for index, start, end in batch for _ in range(start, end)])
+                row_pos = torch.cat([torch.arange(start, end) for _, start, end in batch]) + 1 # +1 because of the start token
+                rows = torch.arange(len(row_pos))
+                tokens_masked = batch_tokens[row_chunk]
+                tokens_masked[rows, row_pos] = alphabet.mask_idx
+                tokens_masked = runtime.pin(tokens_masked)
 
-def run_masked_marginals_model(model_location, chunk_list, batch_size):
+            yield group, batch, tokens_masked, row_pos, batch_tokens[row_chunk, row_pos]
 
-    start_time = default_timer()
-    print('Loading model')
 
-    # Get model name
-    model_name = Path(model_location).stem if model_location.endswith('.pt') else model_location
+def run_masked_marginals_model(models, alphabet, chunks, batch_size, runtime, limits=None):
+    """Score chunks with the masked-marginals strategy.
 
-    # Load model
-    model, alphabet = pretrained.load_model_and_alphabet(model_location)
-    model.eval()
+    Each masked batch is built once and run through every model in `models`.
+    Masked rows of short chunks are packed together (see plan_masked_batches)
+    and batches are built in the background (see prepare_masked_batches).
+    Results are yielded in the original chunk order as soon as they are complete.
+    limits is a BatchLimits, whose probed token budget, if any, sizes batches
+    in place of batch_size.
+    Yields (chunk ID, chunk sequence, scores) where scores is a
+    (models x chunk length x vocabulary size) array of log-probability
+    differences from the reference token.
+    """
 
-    if torch.cuda.is_available():
-        model = model.cuda()
-        print("Transferred model to GPU")
+    limits = limits or BatchLimits()
 
-    print(f'It took {default_timer() - start_time} seconds to load the model.')
+    start_time = default_timer()
 
-    batch_converter = alphabet.get_batch_converter()
+    progress = tqdm(unit='pos')
+    current_group = None
+    for group, batch, tokens_masked, row_pos, wt_tokens in prefetch(
+        prepare_masked_batches(chunks, alphabet, batch_size, runtime, limits.max_tokens)
+    ):
 
-    results = defaultdict(list)
-    # We'll compute one sequence at a time
-    for seq_id, seq_aas, start, end in tqdm(split_to_batches(chunk_list, batch_size)):
-
-        batch_labels, batch_strs, batch_tokens = batch_converter([(seq_id, seq_aas)])
-
-        # Make masked matrix
-        tokens_masked = torch.cat([
-            mask_token_tensor(batch_tokens, alphabet, i)
-            for i in range(start+1, end+1) # +1 because of the start token
-        ])
-
-        if torch.cuda.is_available():
-            tokens_masked = tokens_masked.cuda()
-        
-        with torch.no_grad():
-            token_probs = torch.log_softmax(model(tokens_masked)['logits'], dim=-1)
-        
-        # The result is an B x S x V tensor of probabilities with
+        if group is not current_group:
+            current_group = group
+            group_scores = [None] * len(group)
+            rows_left = [len(chunk_seq) for _, chunk_seq in group]
+            next_index = 0
+
+        with metrics.model_batch(
+            runtime.device,
+            strategy='masked-marginals',
+            rows=len(row_pos),
+            positions=len(row_pos),
+            padded_tokens=tokens_masked.numel(),
+            real_tokens=sum((len(group[index][1]) + 2) * (end - start) for index, start, end in batch),
+            chunks=[[group[index][0], end - start] for index, start, end in batch]
+        ):
+            with metrics.stage('host_transfer', runtime.device):
+                tokens_masked = runtime.to_device(tokens_masked)
+                row_pos_device = row_pos.to(tokens_masked.device)
+            with metrics.stage('forward', runtime.device):
+                masked_probs = score_batch(models, tokens_masked, runtime, limits, row_pos_device)
+            with metrics.stage('host_transfer'):
+                masked_probs = masked_probs.cpu()
+
+        # The result is an M x B x V tensor of probabilities with
+        # Number of models M
         # Batch size B
-        # Sequence length S
         # Vocabulary size V
-        # On row n, the (start + 1 + n)th token is masked.
-        # The masked marginals scores of the substitutions of the (start + 1 + n)th token are
-        # given by the tensor slice at [n,start + 1 + n,:] minus the value at [n,start + 1 + n,w] where
+        # On row n, the token at row_pos[n] is masked, and masked_probs[:,n,:]
+        # holds the probabilities at that position.
+        # The masked marginals scores of the substitutions of that token are
+        # given by the tensor slice at [:,n,:] minus the value at [:,n,w] where
         # w is the vocabulary index of the original token.
-        
-        # Put results in a dataframe
-        results[seq_id].append(pd.DataFrame.from_records(
-            [
-                [start + n, aa] + (token_probs[n, start + n + 1, :] - token_probs[n, start + n + 1, alphabet.get_idx(aa)]).tolist()
-                for n, aa in enumerate(seq_aas[start:end])
-            ],
-            columns=['pos', 'ref'] + alphabet.all_toks,
-            index = ['pos', 'ref']
-        ))
+        with metrics.stage('assembly'):
+            rows = torch.arange(len(row_pos))
+            scores = (masked_probs - masked_probs[:, rows, wt_tokens].unsqueeze(-1)).numpy()
+
+            # Put scores back with their chunks
+            offset = 0
+            for index, start, end in batch:
+                if group_scores[index] is None:
+                    group_scores[index] = np.empty((len(models), len(group[index][1]), scores.shape[-1]), dtype=scores.dtype)
+                group_scores[index][:, start:end, :] = scores[:, offset:offset + end - start, :]
+                rows_left[index] -= end - start
+                offset += end - start
+
+        progress.update(len(rows))
+
+        # Hand over chunks as soon as they and all chunks before them are done
+        while next_index < len(group) and rows_left[next_index] == 0:
+            chunk_id, chunk_seq = group[next_index]
+            yield chunk_id, chunk_seq, group_scores[next_index]
+            group_scores[next_index] = None
+            next_index += 1
+
+    progress.close()
+    elapsed = default_timer() - start_time
+    print(f'It took {elapsed} to generate predictions ({progress.n / elapsed:.1f} positions/sec).')
+
+
+def model_checksum(model_location):
+    """A SHA-256 identifying the contents of a model file, or the name of a pretrained model.
+
+    This avoids reading the whole (multi-GB) file where it can: converted
+    checkpoints carry the SHA-256 of their weights (see checkpoints.py), and
+    `.pt` files are zip archives whose directory lists the CRC-32 and size of
+    every member, which are hashed instead. Other files are hashed in full.
+    """
+
+    path = Path(model_location)
+    if not path.is_file():
+        return model_location
+
+    if checkpoints.is_checkpoint(model_location):
+        digest = checkpoints.read_metadata(path).get('sha256')
+        if digest is not None:
+            return digest
+    elif zipfile.is_zipfile(path):
+        digest = hashlib.sha256()
+        with zipfile.ZipFile(path) as archive:
+            for info in sorted(archive.infolist(), key=lambda info: info.filename):
+                digest.update(f'{info.filename}\t{info.CRC:08x}\t{info.file_size}\n'.encode())
+        return digest.hexdigest()
+
+    start_time = default_timer()
+    digest = hashlib.sha256()
+    with path.open('rb') as in_handle:
+        while block := in_handle.read(1 << 24):
+            digest.update(block)
+    print(f'It took {default_timer() - start_time} seconds to checksum {model_location}.')
+    return digest.hexdigest()
+
+
+def window_hash(chunk_seq):
+    return hashlib.sha256(chunk_seq.encode()).hexdigest()
+
+
+class PredictionCache:
+    """An on-disk cache of chunk scores, so that windows shared between sequences or runs are scored once.
+
+    Scores are stored as `{directory}/{model key}/{hash[:2]}/{hash}.npy`, a
+    (chunk length x vocabulary size) array, where the model key combines the
+    model name and checksum (see model_checksum), scoring strategy and compute
+    precision, and hash is the SHA-256 of the chunk sequence (see window_hash).
+    `{directory}/windows/*.tsv` map chunk IDs (accession and window) to the
+    hashes of their sequences, so cached scores can be fanned back out per ID.
+    Each job appends to a file of its own (`{host}-{pid}.tsv`), so that jobs
+    sharing the cache don't interleave their lines. (Caches from before this
+    layout have a single `{directory}/windows.tsv`, which is still read.)
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        mapping_dir = self.directory / 'windows'
+        mapping_dir.mkdir(parents=True, exist_ok=True)
+
+        self.mapping = {}
+        mapping_paths = sorted(mapping_dir.glob('*.tsv'))
+        if (self.directory / 'windows.tsv').exists():
+            mapping_paths.insert(0, self.directory / 'windows.tsv')
+        for mapping_path in mapping_paths:
+            with mapping_path.open('rt') as in_handle:
+                for line in in_handle:
+                    fields = line.rstrip('\n').split('\t')
+                    if line.endswith('\n') and len(fields) == 2:
+                        self.mapping[fields[0]] = fields[1]
+        self.mapping_path = mapping_dir / f'{socket.gethostname()}-{os.getpid()}.tsv'
+        self.mapping_file = None
+
+    def model_key(self, model_location, scoring_strategy, compute_precision):
+        return f'{get_model_name(model_location)}-{model_checksum(model_location)[:16]}/{scoring_strategy}-{compute_precision}'
+
+    def _path(self, model_key, seq_hash):
+        return self.directory / model_key / seq_hash[:2] / f'{seq_hash}.npy'
+
+    def record(self, chunk_id, seq_hash):
+        """Add a chunk ID to the mapping to window hashes"""
+
+        if self.mapping.get(chunk_id) != seq_hash:
+            self.mapping[chunk_id] = seq_hash
+            if self.mapping_file is None:
+                self.mapping_file = self.mapping_path.open('at')
+            self.mapping_file.write(f'{chunk_id}\t{seq_hash}\n')
+            self.mapping_file.flush()
+
+    def contains(self, model_keys, seq_hash):
+        return all(self._path(model_key, seq_hash).exists() for model_key in model_keys)
+
+    def get(self, model_keys, seq_hash):
+        """A (models x chunk length x vocabulary size) array of cached scores"""
+
+        return np.stack([np.load(self._path(model_key, seq_hash)) for model_key in model_keys])
+
+    def put(self, model_keys, seq_hash, scores):
+        for model_key, model_scores in zip(model_keys, scores):
+            path = self._path(model_key, seq_hash)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first, so that concurrent readers never see a partial array
+            temporary_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+            with temporary_path.open('wb') as out_handle:
+                np.lib.format.write_array(out_handle, model_scores, allow_pickle=False)
+            temporary_path.replace(path)
+
+    def close(self):
+        if self.mapping_file is not None:
+            self.mapping_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def run_cached(cache, model_keys, score, chunks):
+    """Score chunks through a PredictionCache.
+
+    Chunks whose windows are in the cache, or repeat a window met earlier, are
+    read from the cache; the rest are passed on to score, a function that
+    takes chunks and yields (chunk ID, chunk sequence, scores) in order, and
+    their scores are added to the cache.
+    Yields (chunk ID, chunk sequence, scores) in the original chunk order.
 
-    result = pd.concat({seq_id: pd.concat(r) for seq_id, r in results.items()}, names = ['chunk'])
+    score may pull chunks from a background thread (see prefetch), so the
+    chunks are classified as they are pulled, and handed to this thread
+    through a queue: (chunk ID, chunk sequence, hash, whether the chunk goes
+    to score) for every chunk in order, then None. A chunk is queued before it
+    is sent to score, so when its scores come back, it and the chunks before it
+    are in the queue.
+    """
+
+    classified = queue.Queue()
+    hits = 0
+
+    def misses():
+        sent = set()
+        for chunk_id, chunk_seq in chunks:
+            with metrics.stage('cache'):
+                seq_hash = window_hash(chunk_seq)
+                miss = seq_hash not in sent and not cache.contains(model_keys, seq_hash)
+            classified.put((chunk_id, chunk_seq, seq_hash, miss))
+            if miss:
+                sent.add(seq_hash)
+                yield chunk_id, chunk_seq
+        classified.put(None)
+
+    def cached_until_miss():
+        """Yield the cached chunks at the head of the queue, up to the next chunk that went to score"""
+        nonlocal hits
+        while (entry := classified.get()) is not None:
+            chunk_id, chunk_seq, seq_hash, miss = entry
+            with metrics.stage('cache'):
+                cache.record(chunk_id, seq_hash)
+                scores = None if miss else cache.get(model_keys, seq_hash)
+            if miss:
+                return
+            hits += 1
+            yield chunk_id, chunk_seq, scores
+
+    for chunk_id, chunk_seq, scores in score(misses()):
+        yield from cached_until_miss()
+        with metrics.stage('cache'):
+            cache.put(model_keys, window_hash(chunk_seq), scores)
+        yield chunk_id, chunk_seq, scores
+    # Cached chunks after the last one that was scored
+    yield from cached_until_miss()
+
+    print(f'{hits} sequence chunks were read from the prediction cache.')
+    metrics.count(cache_hits=hits)
+
+
+class ResultWriter(ABC):
+    """Base class for writers that put results on disk one chunk at a time.
+
+    Progress is recorded in a manifest next to the results, `{results}.progress`,
+    with one line per completed chunk and model (tab-separated key, chunk ID,
+    and size of the results file), appended once the chunk's results have been
+    flushed. With `resume`, chunks listed in the manifest are skipped and
+    anything written after the last recorded chunk is discarded, so a preempted
+    job can pick up where it left off.
+    """
+
+    def __init__(self, path, resume):
+        self.path = Path(path)
+        self.manifest_path = self.path.with_name(f'{self.path.name}.progress')
+        self.completed = set()
+        self.committed_size = 0
+
+        if resume and self.path.exists() and self.manifest_path.exists():
+            with self.manifest_path.open('rt') as in_handle:
+                for line in in_handle:
+                    fields = line.rstrip('\n').split('\t')
+                    if not line.endswith('\n') or len(fields) != 3:
+                        # Partially written last line
+                        break
+                    key, chunk_id, size = fields
+                    self.completed.add((key, chunk_id))
+                    self.committed_size = int(size)
+            print(f'Resuming with {len(self.completed)} completed chunks from {self.manifest_path}')
+        else:
+            self.manifest_path.unlink(missing_ok=True)
+
+        self.manifest = self.manifest_path.open('at')
+
+    def is_complete(self, key, chunk_id):
+        return (key, chunk_id) in self.completed
+
+    def commit(self, key, chunk_id):
+        """Record that results for chunk_id and key (a model name or ENSEMBLE_MEAN) are on disk"""
+
+        size = self.flush()
+        self.manifest.write(f'{key}\t{chunk_id}\t{size}\n')
+        self.manifest.flush()
+        self.completed.add((key, chunk_id))
+
+    @abstractmethod
+    def flush(self):
+        """Flush results to disk, returning the size of the results file"""
+
+    def close(self):
+        self.manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CsvResultWriter(ResultWriter):
+    """Writes results as CSV with one row per chunk position and model, and a column for every vocabulary token.
+
+    Ensemble results are instead written with one row per substitution, i.e.
+    columns chunk, pos, ref, alt, one column per model, and ENSEMBLE_MEAN.
+    """
+
+    def __init__(self, path, precision, resume=False):
+        super().__init__(path, resume)
+        alphabet = Alphabet.from_architecture('ESM-1b')
+        self.columns = ['chunk', 'pos', 'ref'] + alphabet.all_toks + ['model']
+        self.token_indices = [alphabet.get_idx(aa) for aa in AA_TOKENS]
+
+        if self.completed:
+            # Drop anything written after the last completed chunk
+            with self.path.open('r+b') as out_handle:
+                out_handle.truncate(self.committed_size)
+            self.out_handle = self.path.open('at', newline='')
+        else:
+            self.out_handle = self.path.open('wt', newline='')
+
+    def _append(self, frame):
+        frame.to_csv(self.out_handle, index=False, header=self.out_handle.tell() == 0)
+
+    def write(self, chunk_id, chunk_seq, model_name, scores):
+        with metrics.stage('assembly'):
+            frame = pd.DataFrame(scores.astype(np.float64), columns=self.columns[3:-1])
+            frame.insert(0, 'chunk', chunk_id)
+            frame.insert(1, 'pos', np.arange(len(chunk_seq)))
+            frame.insert(2, 'ref', list(chunk_seq))
+            frame['model'] = model_name
+        with metrics.stage('write'):
+            self._append(frame)
+            self.commit(model_name, chunk_id)
+
+    def write_ensemble(self, chunk_id, chunk_seq, model_names, scores):
+        with metrics.stage('assembly'):
+            # float64, like the per-model outputs (and the mean over models is taken at that precision)
+            aa_scores = scores[:, :, self.token_indices].astype(np.float64)
+            frame = pd.DataFrame({
+                'chunk': chunk_id,
+                'pos': np.repeat(np.arange(len(chunk_seq)), len(AA_TOKENS)),
+                'ref': np.repeat(list(chunk_seq), len(AA_TOKENS)),
+                'alt': np.tile(list(AA_TOKENS), len(chunk_seq))
+            })
+            for model_name, model_scores in zip(model_names, aa_scores):
+                frame[model_name] = model_scores.reshape(-1)
+            frame[ENSEMBLE_MEAN] = aa_scores.mean(axis=0).reshape(-1)
+        with metrics.stage('write'):
+            self._append(frame)
+            self.commit(ENSEMBLE_MEAN, chunk_id)
 
-    print(f'It took {default_timer() - start_time} to generate predictions.')
+    def flush(self):
+        self.out_handle.flush()
+        return self.out_handle.tell()
 
-    result['model'] = model_name
-    result.set_index('model', append=True)
+    def close(self):
+        self.out_handle.close()
+        super().close()
 
-    return result
+
+def read_local_zip_members(path):
+    """Yield (name, data) for the complete members of a zip archive, read from their local file headers.
+
+    This recovers the contents of an archive that was never closed, and so
+    has no central directory. Only uncompressed members are supported.
+    """
+
+    with open(path, 'rb') as in_handle:
+        while True:
+            header = in_handle.read(30)
+            if len(header) < 30 or header[:4] != b'PK\x03\x04':
+                return
+            _, _, _, _, _, _, _, crc, compress_size, _, name_length, extra_length = struct.unpack(
+                '<4s2B4HL2L2H', header
+            )
+            name = in_handle.read(name_length).decode()
+            extra = in_handle.read(extra_length)
+            while compress_size == 0xFFFFFFFF and len(extra) >= 4:
+                # Zip64 sizes
+                header_id, data_size = struct.unpack('<HH', extra[:4])
+                if header_id == 1:
+                    _, compress_size = struct.unpack('<QQ', extra[4:20])
+                extra = extra[4 + data_size:]
+            data = in_handle.read(compress_size)
+            if len(data) < compress_size or zlib.crc32(data) != crc:
+                return
+            yield name, data
+
+
+class NpzResultWriter(ResultWriter):
+    """Writes results as a zip of .npy arrays, readable with numpy.load.
+
+    The archive contains:
+    * `columns`: The amino acid tokens (AA_TOKENS) that score columns correspond to.
+    * `ref/{chunk ID}`: The chunk sequence, as a string scalar.
+    * `scores/{model name}/{chunk ID}`: A (chunk length x amino acids) array of scores.
+      Ensemble runs also write the mean over models as ENSEMBLE_MEAN.
+
+    Chunk IDs carry the window, i.e. `{sequence ID}[{start}:{end}]`.
+    Arrays are written as they come in.
+    """
+
+    def __init__(self, path, precision, resume=False):
+        super().__init__(path, resume)
+        alphabet = Alphabet.from_architecture('ESM-1b')
+        self.token_indices = [alphabet.get_idx(aa) for aa in AA_TOKENS]
+        self.dtype = np.dtype(precision)
+
+        if self.completed:
+            if not zipfile.is_zipfile(self.path):
+                self._salvage()
+            self.archive = zipfile.ZipFile(self.path, 'a')
+        else:
+            self.archive = zipfile.ZipFile(self.path, 'w')
+        self.names = set(self.archive.namelist())
+
+        self._write_array('columns', np.array(list(AA_TOKENS)))
+
+    def _salvage(self):
+        """Rebuild an archive that was not closed (e.g. the job was preempted), keeping completed chunks"""
+
+        keep = {'columns.npy'}
+        for key, chunk_id in self.completed:
+            keep.update([f'ref/{chunk_id}.npy', f'scores/{key}/{chunk_id}.npy'])
+
+        salvaged_path = self.path.with_name(f'{self.path.name}.salvage')
+        with zipfile.ZipFile(salvaged_path, 'w') as archive:
+            for name, data in read_local_zip_members(self.path):
+                if name in keep:
+                    archive.writestr(name, data)
+        salvaged_path.replace(self.path)
+
+    def _write_array(self, name, array):
+        name = f'{name}.npy'
+        if name in self.names:
+            return
+        with self.archive.open(name, 'w', force_zip64=True) as out_handle:
+            np.lib.format.write_array(out_handle, array, allow_pickle=False)
+        self.names.add(name)
+
+    def write(self, chunk_id, chunk_seq, model_name, scores):
+        with metrics.stage('assembly'):
+            scores = scores[:, self.token_indices].astype(self.dtype)
+        with metrics.stage('write'):
+            self._write_array(f'ref/{chunk_id}', np.array(chunk_seq))
+            self._write_array(f'scores/{model_name}/{chunk_id}', scores)
+            self.commit(model_name, chunk_id)
+
+    def write_ensemble(self, chunk_id, chunk_seq, model_names, scores):
+        for model_name, model_scores in zip(model_names, scores):
+            self.write(chunk_id, chunk_seq, model_name, model_scores)
+        with metrics.stage('assembly'):
+            mean = scores.mean(axis=0)
+        self.write(chunk_id, chunk_seq, ENSEMBLE_MEAN, mean)
+
+    def flush(self):
+        self.archive.fp.flush()
+        return self.archive.fp.tell()
+
+    def close(self):
+        self.archive.close()
+        super().close()
+
+
+RESULT_WRITERS = {
+    'csv': CsvResultWriter,
+    'npz': NpzResultWriter
+}
 
 
 def main(args):
 
+    runtime = inference.Runtime.from_args(args)
+    memory_limit = args.memory_limit and int(args.memory_limit * 2**30)
+    if memory_limit and runtime.device.type == 'cuda':
+        total = torch.cuda.get_device_properties(runtime.device).total_memory
+        torch.cuda.set_per_process_memory_fraction(min(1.0, memory_limit / total), runtime.device)
+    metrics.configure(
+        args.metrics,
+        args.profile_batch,
+        script='predict_substitutions',
+        args=vars(args),
+        runtime=str(runtime)
+    )
+
     # Select scoring method
+    limits = BatchLimits()
     run_model = {
-        'wt-marginals': run_wt_marginals_model,
-        'masked-marginals': run_masked_marginals_model
+        'wt-marginals': partial(
+            run_wt_marginals_model,
+            max_tokens=args.max_tokens or args.batch_size * (MAX_SEQ_LENTH + 2),
+            runtime=runtime,
+            limits=limits
+        ),
+        'masked-marginals': partial(
+            run_masked_marginals_model, batch_size=args.batch_size, runtime=runtime, limits=limits
+        )
     }[args.scoring_strategy]
 
-    # Read (possibly gzipped) fasta
-    if args.sequences.suffix == '.gz':
-        with gzip.open(args.sequences, 'rt') as in_handle:
-            seq_list = SeqIO.parse(in_handle, 'fasta')
-    else:
-        seq_list = SeqIO.parse(args.sequences, 'fasta')
+    def remaining_chunks(key):
+        """Stream chunks from the (possibly gzipped) fasta, skipping chunks that are already complete"""
+        return (
+            chunk
+            for chunk in metrics.timed('chunking', chunk_sequences(metrics.timed('fasta_parse', read_sequences(args.sequences))))
+            if not writer.is_complete(key, chunk[0])
+        )
+
+    def score_chunks(model_locations, chunks):
+        """Score chunks with the given models, loading them only once there is a chunk to score"""
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return
+        models = [load_model(model_location, runtime) for model_location in model_locations]
+        alphabet = models[0][1]
+        if args.auto_batch_size:
+            # Probed with the models of the first run, i.e. all of them in an ensemble
+            limits.max_tokens = limits.max_tokens or probe_max_tokens(
+                [model for model, _ in models], alphabet, runtime, memory_limit,
+                masked=args.scoring_strategy == 'masked-marginals'
+            )
+        yield from run_model([model for model, _ in models], alphabet, chain([first_chunk], chunks))
 
-    # Break sequences up into digestible chunks
-    chunk_list = chunk_sequences(seq_list)
+    def predict(model_locations, chunks):
+        """Yield (chunk ID, chunk sequence, scores) for chunks, going through the cache if there is one"""
+        if cache is None:
+            return score_chunks(model_locations, chunks)
+        model_keys = [
+            cache.model_key(model_location, args.scoring_strategy, args.compute_precision)
+            for model_location in model_locations
+        ]
+        return run_cached(cache, model_keys, partial(score_chunks, model_locations), chunks)
 
-    # Produce results and collate:
-    pd.concat([
-        run_model(model_location, chunk_list, args.batch_size)
-        for model_location in args.model_location
-    ]).to_csv(args.results)
+    # Produce results and write them out as they come
+    with (
+        RESULT_WRITERS[args.format](args.results, args.precision, args.resume) as writer,
+        PredictionCache(args.cache) if args.cache else nullcontext() as cache,
+        metrics.recorder
+    ):
+        if args.ensemble:
+            model_names = [get_model_name(model_location) for model_location in args.model_location]
+            for chunk_id, chunk_seq, scores in predict(args.model_location, remaining_chunks(ENSEMBLE_MEAN)):
+                writer.write_ensemble(chunk_id, chunk_seq, model_names, scores)
+        else:
+            for model_location in args.model_location:
+                model_name = get_model_name(model_location)
+                remaining = remaining_chunks(model_name)
+                first_chunk = next(remaining, None)
+                if first_chunk is None:
+                    print(f'All chunks are complete for {model_name}')
+                    continue
+                for chunk_id, chunk_seq, scores in predict([model_location], chain([first_chunk], remaining)):
+                    writer.write(chunk_id, chunk_seq, model_name, scores[0])
 
 if __name__ == '__main__':
     parser = create_parser()
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,30 @@
+"""How sequences are split into windows that fit ESM-1v.
+
+ESM-1v takes at most 1022 AAs, so longer sequences are scored as overlapping
+windows. predict_substitutions.py splits sequences with windows, and the
+scripts that plan or check its jobs (bundle-sequences.py, plan-missing-work.py)
+import it from here, so that they always agree on the windows. This module
+has no dependencies, so those scripts don't need the prediction environment.
+"""
+
+# ESM-1v models won't handle sequences longer than 1024.
+# Accounting for the start and end tokens this leaves 1022 AAs.
+# To process larger proteins, we break up the sequences into chunks of 1022
+# AAs, but we maintain an overlap between consecutive chunks to eliminate
+# start-of-sequence and end-of-sequence biases.
+MAX_SEQ_LENTH = 1022
+SEQ_OVERLAP = 100
+
+
+def windows(length):
+    """(start, end) of the windows of a sequence of the given length"""
+
+    result = []
+    start = 0
+    while start < length:
+        end = min(start + MAX_SEQ_LENTH, length)
+        result.append((start, end))
+        if end == length:
+            break
+        start += MAX_SEQ_LENTH - SEQ_OVERLAP
+    return result
@@ -0,0 +1,269 @@
+"""
+Plan the prediction jobs still needed to cover a set of sequences.
+
+Compares the windows and models that the sequences call for against the raw
+per-model outputs of predict_substitutions.py and the processed outputs of
+process-results.py, and writes FASTA bundles and an HTCondor queue file
+covering only what is missing (see chtc/run-missing.submit).
+
+A protein counts as done if its processed output is complete: a valid gzip
+(or Parquet file) with one row per substitution and a column for every model. Otherwise each
+(window, model) counts as done if a raw output holds all of its positions.
+Raw outputs that have a progress manifest (predict_substitutions.py writes
+`{results}.progress`) are checked against the manifest instead of being read.
+Windows missing for a model are written as records with chunk IDs,
+`{sequence ID}[{start}:{end}]`, which predict_substitutions.py scores as is,
+or as the whole sequence if all of its windows are missing.
+"""
+
+from pathlib import Path
+import gzip
+import sys
+import zipfile
+from collections import defaultdict
+
+import pandas as pd
+from Bio import SeqIO
+from tqdm import tqdm
+
+# The windowing of the prediction script
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'container'))
+from windowing import windows
+
+AA_COLS = 'LAGVSERTIDPKQNFYMHWCUO' # Should match process-results.py
+ENSEMBLE_MEAN = 'ensemble_mean'
+MODEL_NAME = 'esm1v_t33_650M_UR90S_{}'
+# Suffixes of the processed outputs of process-results.py (see its --writer)
+PROCESSED_SUFFIXES = ('.tsv.gz', '.parquet')
+
+
+def create_parser():
+    """Command line argument parser. This also serves as a reference."""
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser('Plan prediction jobs for missing windows and models')
+    parser.add_argument(
+        '--sequences',
+        type=Path,
+        nargs='+',
+        help='FASTA files (can be gzipped) of the sequences that should be covered.'
+    )
+    parser.add_argument(
+        '--raw',
+        type=Path,
+        nargs='*',
+        default=[],
+        help='Raw prediction files (CSV, ensemble CSV or npz) from predict_substitutions.py.'
+    )
+    parser.add_argument(
+        '--processed-dir',
+        type=Path,
+        nargs='*',
+        default=[],
+        help='Directories of processed outputs ({sequence ID}.tsv.gz or .parquet) from process-results.py.'
+    )
+    parser.add_argument(
+        '--models',
+        type=int,
+        nargs='+',
+        default=[1, 2, 3, 4, 5],
+        help=f'Numbers of the ESM-1v models ({MODEL_NAME.format("N")}) that should cover each window.'
+    )
+    parser.add_argument(
+        '--output-dir',
+        type=Path,
+        help='Directory to write FASTA bundles (bundle_{i}_m{model}.fasta) and queue.txt to.'
+    )
+    parser.add_argument(
+        '--bundle-windows',
+        type=int,
+        default=1000,
+        help='Maximum number of windows per FASTA bundle.'
+    )
+    return parser
+
+
+def read_sequences(paths):
+    """Dictionary of sequence ID to sequence string"""
+
+    sequences = {}
+    for path in paths:
+        opener = gzip.open if path.suffix == '.gz' else open
+        with opener(path, 'rt') as in_handle:
+            for record in SeqIO.parse(in_handle, 'fasta'):
+                sequences[record.id] = str(record.seq)
+    return sequences
+
+
+def processed_complete(path: Path, length, model_names):
+    """Whether a processed output is intact and has every substitution and model"""
+
+    if path.name.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        try:
+            # Rows and columns are in the footer, which a truncated file lacks
+            metadata = pq.read_metadata(path)
+        except (OSError, ValueError):
+            return False
+        header = metadata.schema.names
+        rows = metadata.num_rows
+    else:
+        try:
+            with gzip.open(path, 'rt') as in_handle:
+                header = in_handle.readline().rstrip('\n').split('\t')
+                rows = sum(1 for _ in in_handle)
+        except (OSError, EOFError):
+            # Truncated or not a gzip file
+            return False
+    return rows == length * len(AA_COLS) and set(model_names) <= set(header)
+
+
+def read_manifest(path: Path):
+    """Keys and chunk IDs committed in a progress manifest, or None if the results were truncated since"""
+
+    committed = []
+    size = 0
+    with path.open('rt') as in_handle:
+        for line in in_handle:
+            fields = line.rstrip('\n').split('\t')
+            if not line.endswith('\n') or len(fields) != 3:
+                break
+            committed.append((fields[0], fields[1]))
+            size = int(fields[2])
+
+    results_path = path.with_name(path.name[:-len('.progress')])
+    if results_path.stat().st_size < size:
+        return None
+    return committed
+
+
+def raw_complete(path: Path, chunk_lengths, model_names):
+    """Set of (chunk ID, model name) that a raw output holds completely"""
+
+    manifest_path = path.with_name(f'{path.name}.progress')
+    if manifest_path.exists():
+        committed = read_manifest(manifest_path)
+        if committed is not None:
+            done = set()
+            for key, chunk_id in committed:
+                done.update((chunk_id, model) for model in (model_names if key == ENSEMBLE_MEAN else [key]))
+            return done
+        print(f'{path} is shorter than its progress manifest records, reading it in full')
+
+    if path.suffix == '.npz':
+        # Arrays are only added to the archive once complete
+        if not zipfile.is_zipfile(path):
+            print(f'{path} is not a complete npz archive, skipping it')
+            return set()
+        with zipfile.ZipFile(path) as archive:
+            return {
+                (chunk_id, model)
+                for _, model, chunk_id in (
+                    name[:-len('.npy')].split('/', 2) for name in archive.namelist() if name.startswith('scores/')
+                )
+                if model in model_names
+            }
+
+    # Rows per (chunk ID, model), and the number of rows a complete chunk has
+    rows = defaultdict(int)
+    columns = pd.read_csv(path, nrows=0).columns
+    if 'alt' in columns:
+        # Ensemble output, one row per substitution and a column per model.
+        # A truncated last row lacks the mean.
+        rows_per_position = len(AA_COLS)
+        for frame in pd.read_csv(path, usecols=['chunk', ENSEMBLE_MEAN], chunksize=1000000):
+            for chunk_id, count in frame[frame[ENSEMBLE_MEAN].notna()].groupby('chunk').size().items():
+                for model in columns.intersection(model_names):
+                    rows[chunk_id, model] += count
+    else:
+        # One row per position and model. A truncated last row lacks (all of) the model name.
+        rows_per_position = 1
+        for frame in pd.read_csv(path, usecols=['chunk', 'model'], chunksize=1000000):
+            for key, count in frame.groupby(['chunk', 'model']).size().items():
+                rows[key] += count
+
+    return {
+        (chunk_id, model)
+        for (chunk_id, model), count in rows.items()
+        if model in model_names and count == chunk_lengths.get(chunk_id, 0) * rows_per_position
+    }
+
+
+def write_bundle(path: Path, sequences, seq_windows, bundle):
+    """Write a FASTA of the (sequence ID, start, end) windows in bundle.
+
+    Sequences with all of their windows in the bundle are written whole,
+    other windows as records with their chunk ID.
+    """
+
+    by_sequence = defaultdict(list)
+    for seq_id, start, end in bundle:
+        by_sequence[seq_id].append((start, end))
+
+    with path.open('wt') as out_handle:
+        for seq_id, bundle_windows in by_sequence.items():
+            sequence = sequences[seq_id]
+            if bundle_windows == seq_windows[seq_id]:
+                out_handle.write(f'>{seq_id}\n{sequence}\n')
+            else:
+                for start, end in bundle_windows:
+                    out_handle.write(f'>{seq_id}[{start}:{end}]\n{sequence[start:end]}\n')
+
+
+def main(args):
+
+    sequences = read_sequences(args.sequences)
+    model_names = [MODEL_NAME.format(model) for model in args.models]
+
+    seq_windows = {seq_id: windows(len(sequence)) for seq_id, sequence in sequences.items()}
+    chunk_lengths = {
+        f'{seq_id}[{start}:{end}]': end - start
+        for seq_id, seq_id_windows in seq_windows.items()
+        for start, end in seq_id_windows
+    }
+
+    processed = set()
+    for directory in args.processed_dir:
+        paths = sorted(path for suffix in PROCESSED_SUFFIXES for path in directory.glob(f'*{suffix}'))
+        for path in tqdm(paths, desc=f'Checking {directory}'):
+            seq_id = next(path.name[:-len(suffix)] for suffix in PROCESSED_SUFFIXES if path.name.endswith(suffix))
+            if seq_id in sequences and processed_complete(path, len(sequences[seq_id]), model_names):
+                processed.add(seq_id)
+
+    done = set()
+    for path in tqdm(args.raw, desc='Checking raw outputs'):
+        done.update(raw_complete(path, chunk_lengths, model_names))
+
+    # Missing (sequence ID, start, end) per model, in sequence order
+    missing = {
+        model: [
+            (seq_id, start, end)
+            for seq_id, seq_id_windows in seq_windows.items()
+            if seq_id not in processed
+            for start, end in seq_id_windows
+            if (f'{seq_id}[{start}:{end}]', model_name) not in done
+        ]
+        for model, model_name in zip(args.models, model_names)
+    }
+
+    print(f'{len(sequences)} sequences, {len(chunk_lengths)} windows, {len(processed)} sequences processed')
+    for model, model_name in zip(args.models, model_names):
+        print(f'{model_name}: {len(missing[model])} windows missing')
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    bundles = 0
+    with (args.output_dir / 'queue.txt').open('wt') as queue_handle:
+        for model, model_missing in missing.items():
+            for i in range(0, len(model_missing), args.bundle_windows):
+                file_name = f'bundle_{bundles}_m{model}.fasta'
+                write_bundle(args.output_dir / file_name, sequences, seq_windows, model_missing[i:i + args.bundle_windows])
+                queue_handle.write(f'{file_name}, {model}\n')
+                bundles += 1
+
+    print(f'Wrote {bundles} bundles to {args.output_dir}')
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args()
+    main(args)
@@ -10,9 +10,18 @@ This accomplishes several actions:
   row.
 * We express substitutions using the HGVS standard
 * We summarize results across the 5 models
+* We write one file per protein, as gzipped TSV by default (see --writer)
 """
 
 from pathlib import Path
+from collections import defaultdict, deque
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from timeit import default_timer
+import io
+import os
+import struct
+import zlib
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
@@ -43,8 +52,34 @@ AA_NAMES = {
     'U': 'Sec',
     'O': 'Pyl'
 }
+# Alternate AAs in output order (by three letter code). Variants are keyed by
+# their position and the codes (indices) of their reference and alternate AAs
+# in this order, and get their HGVS IDs only when written.
+ALTS = ''.join(sorted(AA_COLS, key=AA_NAMES.get))
+# Three letter names by AA code; unknown reference AAs (code -1) are Xaa
+CODE_NAMES = np.array([AA_NAMES[aa] for aa in ALTS] + ['Xaa'], dtype=object)
+VARIANT_KEYS = ['pos', 'alt', 'ref']
 SEQ_OVERLAP = 100 # Sequence overlap for long sequences. Should match value used in prediction script.
 
+# Name of the mean over models in ensemble outputs (predict_substitutions.py --ensemble)
+ENSEMBLE_MEAN = 'ensemble_mean'
+ID_COLS = ['seq', 'start', 'end', 'pos', 'ref', 'alt', 'model']
+
+# Output formats (--writer) and the suffixes of their files
+WRITERS = {'gzip': '.tsv.gz', 'bgzf': '.tsv.gz', 'parquet': '.parquet'}
+# Uncompressed bytes per BGZF block (as htslib uses) and the empty block that ends a BGZF file
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Columns and compact types used when streaming raw predictions
+STREAM_DTYPES = {
+    'chunk': str,
+    'pos': 'int32',
+    'ref': 'category',
+    'model': 'category',
+    **{aa: 'float32' for aa in AA_COLS}
+}
+
 
 def create_parser():
     """Command line argument parser. This also serves as a reference."""
@@ -54,7 +89,8 @@ def create_parser():
     parser.add_argument(
         '--source',
         type=Path,
-        nargs='+'
+        nargs='+',
+        help='Raw prediction files, as CSV or as npz (predict_substitutions.py --format npz).'
     )
     parser.add_argument(
         '--output-dir',
@@ -64,80 +100,353 @@ def create_parser():
         '--overwrite',
         action='store_true'
     )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help=(
+            'Read sources in chunks and process one protein at a time, so that memory use '
+            'tracks the largest protein rather than all sources. '
+            'Each source must list its proteins contiguously and in the same order, '
+            'as the per-model outputs of the prediction jobs do.'
+        )
+    )
+    parser.add_argument(
+        '--chunk-rows',
+        type=int,
+        default=100000,
+        help='Number of rows read from each source at a time in --stream mode.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help=(
+            'Number of processes that stitch and write proteins in parallel. '
+            'Sources are still read by the main process.'
+        )
+    )
+    parser.add_argument(
+        '--writer',
+        type=str,
+        default='gzip',
+        choices=list(WRITERS),
+        help=(
+            'Output format. gzip: {seq}.tsv.gz (default). '
+            'bgzf: {seq}.tsv.gz in blocked gzip, compressed by --compression-threads threads; '
+            'readable by anything that reads gzip, and indexable with bgzip/tabix tools. '
+            'parquet: {seq}.parquet with zstd compression (needs pyarrow). '
+            'plan-missing-work.py, variant_store.py and container/predict.py --from-store read all of these.'
+        )
+    )
+    parser.add_argument(
+        '--compression-level',
+        type=int,
+        help='Compression level of the output, 1 (fastest) to 9 for gzip and bgzf. Defaults to 9 for gzip, 6 for bgzf.'
+    )
+    parser.add_argument(
+        '--compression-threads',
+        type=int,
+        default=4,
+        help='Number of threads compressing each bgzf output.'
+    )
+    parser.add_argument(
+        '--decimals',
+        type=int,
+        help=(
+            'Write scores with this many decimal places (e.g. 4) instead of full float precision, '
+            'which makes outputs smaller and faster to write.'
+        )
+    )
     return parser
 
 
-def merge_estimates(df: pd.DataFrame):
-    if df.shape[0] == 1:
-        result = df.reset_index(['pos', 'start', 'end'], drop=True)
-        result['combined_score'] = result.mean(axis='columns')
+def aa_codes(aas):
+    """Codes (indices in ALTS) of single letter AAs, -1 for any other"""
+
+    return pd.Categorical(aas, categories=list(ALTS)).codes.astype(np.int8)
+
+
+def compose_hgvs(seq, pos, ref, alt):
+    """HVGS strings, i.e. {seq}:p.{ref}{pos}{alt}, of variants given by (0-based) positions and AA codes"""
 
-    elif df.shape[0] == 2:
-        sorted = df.sort_values('start')
+    pos = np.asarray(pos)
+    pos_names = np.arange(1, pos.max() + 2).astype(str).astype(object) if pos.size else np.array([], dtype=object)
+    return f'{seq}:p.' + CODE_NAMES[np.asarray(ref)] + pos_names[pos] + CODE_NAMES[np.asarray(alt)]
 
-        line = sorted.iloc[[0],:].reset_index(['pos', 'start', 'end'], drop=True)
-        next_line = (
-            sorted.iloc[[1],:]
-            .reset_index(['pos', 'start', 'end'], drop=True)
-            .rename(columns = lambda s: f'{s}_next')
+
+def melt_alts(df: pd.DataFrame):
+    """Reshape per-window predictions from reference AA x alternate AA to one row per (variant, window, model)"""
+
+    rows = len(df)
+    return pd.DataFrame({
+        'pos': np.repeat(df['pos'].to_numpy(), len(ALTS)),
+        'alt': np.tile(np.arange(len(ALTS), dtype=np.int8), rows),
+        'ref': np.repeat(aa_codes(df['ref']), len(ALTS)),
+        'start': np.repeat(df['start'].to_numpy(), len(ALTS)),
+        'end': np.repeat(df['end'].to_numpy(), len(ALTS)),
+        'model': np.repeat(df['model'].to_numpy(), len(ALTS)),
+        'score': df[list(ALTS)].to_numpy().reshape(-1)
+    })
+
+
+def pivot_models(df: pd.DataFrame):
+    """Reshape per-window predictions to one row per variant and window.
+
+    Predictions are in the shape of reference AA x alternate AA, the result has
+    one (variant, window) pair per row, indexed by VARIANT_KEYS, start and end,
+    and one column per model.
+    Ensemble outputs already have one substitution per row and a column per
+    model, so they only need to be indexed.
+    """
+
+    if 'alt' in df.columns:
+        model_cols = [col for col in df.columns if col not in ID_COLS + [ENSEMBLE_MEAN]]
+        return (
+            df
+            .assign(alt=aa_codes(df['alt']), ref=aa_codes(df['ref']))
+            .set_index(VARIANT_KEYS + ['start', 'end'])
+            [model_cols]
+            .rename_axis(columns='model')
         )
 
-        result = pd.concat((line, next_line), axis='columns')
-
-        # Merging calculation
-        # This uses a cosine sigmoid to smoothly transition from the leading
-        # sequence to the trailing sequence. Specifically, the score is
-        # s0 * w + s1 * (1 - w)
-        # where s0 and s1 are the means of the scores for the leading and
-        # trailing sequences respectively. For a position that is p
-        # (proportionally) into the overlap,
-        # w = { 1 for p < 0.2
-        #     { 0 for p > 0.8
-        #     { (1 + cos( pi * (p - 0.2) / 0.6 )) / 2 for p in [0.2, 0.8]
-
-        index_df = sorted.index.to_frame(index=False)
-
-        overlap_start = index_df['end'][0]
-        overlap_end = index_df['start'][1]
-        pos = index_df['pos'][0]
-        relative_pos = pos - overlap_start / (overlap_end - overlap_start)
-
-        means = sorted.mean(axis='columns')
-        if relative_pos < 0.2:
-            score = means[0]
-        elif relative_pos > 0.8:
-            score = means[1]
-        else:
-            weight = (1 + np.cos(np.pi * (relative_pos - 0.2) / 0.6)) / 2
-            score = means[0] * weight + means[1] * (1-weight)
-        
-        result['combined_score'] = score
+    return (
+        # Pivot longer on alt AAs, then wider on models
+        melt_alts(df)
+        .pivot(
+            index=VARIANT_KEYS + ['start', 'end'],
+            columns='model',
+            values='score'
+        )
+    )
 
-    else:
-        raise ValueError(f'Unexpected frame shape: {df.shape}; expected 1 or 2 rows. DF: {df}')
+
+def overlap_weights(pos, overlap_start, overlap_end):
+    """Weight of the leading window's score for positions in a window overlap.
+
+    This uses a cosine sigmoid to smoothly transition from the leading
+    sequence to the trailing sequence. Specifically, the score is
+    s0 * w + s1 * (1 - w)
+    where s0 and s1 are the means of the scores for the leading and
+    trailing sequences respectively. For a position that is p
+    (proportionally) into the overlap,
+    w = { 1 for p < 0.2
+        { 0 for p > 0.8
+        { (1 + cos( pi * (p - 0.2) / 0.6 )) / 2 for p in [0.2, 0.8]
+    """
+
+    # Computed exactly as the per-variant merge did, with overlap_start the end
+    # of the leading window and overlap_end the start of the trailing one.
+    # This evaluates to more than 0.8 at every overlap position, so overlaps
+    # take the trailing window's mean rather than the blend described above.
+    # Kept so that scores match those already published; correcting it changes
+    # combined_score in overlaps and calls for regenerating all processed outputs.
+    relative_pos = pos - overlap_start / (overlap_end - overlap_start)
+    return np.where(
+        relative_pos < 0.2,
+        1.0,
+        np.where(
+            relative_pos > 0.8,
+            0.0,
+            (1 + np.cos(np.pi * (relative_pos - 0.2) / 0.6)) / 2
+        )
+    )
+
+
+def stitch_windows(df: pd.DataFrame):
+    """Merge estimates from overlapping windows.
+
+    Takes the output of pivot_models, i.e. one row per (variant, window), and
+    returns one row per variant, indexed by VARIANT_KEYS in order. Variants covered by two windows get the
+    trailing window's model scores in additional `{model}_next` columns, and
+    `combined_score` blends the two window means with overlap_weights.
+    All variants are handled at once rather than one group at a time.
+    """
+
+    df = df.sort_index(level=VARIANT_KEYS + ['start'])
+    index_df = df.index.to_frame(index=False)
+    keys = index_df[VARIANT_KEYS].to_numpy()
+
+    # Rows sharing the variant of the preceding row come from the trailing window
+    is_next = np.concatenate([[False], (keys[1:] == keys[:-1]).all(axis=1)])
+    if (is_next[1:] & is_next[:-1]).any():
+        counts = index_df.groupby(VARIANT_KEYS).size()
+        raise ValueError(
+            f'Unexpected number of windows for variants: {counts[counts > 2].to_dict()}; '
+            'expected 1 or 2.'
+        )
+
+    lead = ~is_next
+    trail_rows = np.flatnonzero(is_next)
+    # Row numbers (among leading rows) of variants that have a trailing window
+    paired = np.cumsum(lead)[trail_rows - 1] - 1
+
+    scores = df.to_numpy(dtype=float)
+    # Average in float64 like the scores, also for float32 sources (--stream, npz)
+    means = df.astype(float).mean(axis='columns').to_numpy()
+
+    result = pd.DataFrame(
+        scores[lead],
+        index=pd.MultiIndex.from_frame(index_df.loc[lead, VARIANT_KEYS]),
+        columns=df.columns
+    )
+    combined = means[lead]
+
+    if trail_rows.size:
+        next_scores = np.full((result.shape[0], scores.shape[1]), np.nan)
+        next_scores[paired] = scores[trail_rows]
+        for i, column in enumerate(df.columns):
+            result[f'{column}_next'] = next_scores[:, i]
+
+        weight = overlap_weights(
+            index_df['pos'].to_numpy()[trail_rows],
+            index_df['end'].to_numpy()[trail_rows - 1],
+            index_df['start'].to_numpy()[trail_rows]
+        )
+        combined[paired] = means[trail_rows - 1] * weight + means[trail_rows] * (1 - weight)
+
+    result['combined_score'] = combined
 
     return result
 
 
-def hgvs_order(ind: pd.Index):
-    """Key for ordering hgvs variants (by sequence ID, then position, then alternate AA)"""
+def label_variants(seq, df: pd.DataFrame):
+    """Replace the VARIANT_KEYS index of a protein's variants with their HGVS IDs"""
+
+    index_df = df.index.to_frame(index=False)
+    hgvs = compose_hgvs(seq, index_df['pos'], index_df['ref'], index_df['alt'])
+    return df.set_axis(pd.Index(hgvs, name='HGVS'), axis='index')
+
+
+def bgzf_block(data: bytes, level):
+    """A BGZF block: a gzip member holding data, with the block size in the BC extra field"""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class BgzfWriter(io.RawIOBase):
+    """Binary file writing BGZF, with blocks compressed in a thread pool and written in order.
+
+    zlib releases the GIL while compressing, so the threads run in parallel.
+    Used as a context manager, the file only gets its end-of-file marker if the
+    block exits cleanly; otherwise the partial file is removed (see discard), so
+    that it can't pass for a complete one.
+    """
+
+    def __init__(self, path: Path, level=6, threads=4):
+        self.path = Path(path)
+        self.out_handle = open(path, 'wb')
+        self.level = level
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.buffer = bytearray()
+        self.pending = deque()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, data):
+        self.pending.append(self.executor.submit(bgzf_block, data, self.level))
+        # Write finished blocks, waiting once a few blocks per thread are queued
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.threads):
+            self.out_handle.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.out_handle.write(self.pending.popleft().result())
+            self.out_handle.write(BGZF_EOF)
+        finally:
+            self.executor.shutdown()
+            self.out_handle.close()
+            super().close()
+
+    def discard(self):
+        """Close without writing the remaining blocks or the end-of-file marker, and remove the file"""
+
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.buffer.clear()
+            self.executor.shutdown()
+            self.out_handle.close()
+            super().close()
+        self.path.unlink(missing_ok=True)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.discard()
+            raise
+
+
+def write_tsv(df: pd.DataFrame, out_file: Path, bgzf=False, level=None, threads=4, decimals=None):
+    """Write processed predictions as gzipped (or BGZF) TSV"""
+
+    float_format = None if decimals is None else f'%.{decimals}f'
+    if not bgzf:
+        df.to_csv(
+            out_file,
+            sep='\t',
+            float_format=float_format,
+            compression={'method': 'gzip', 'compresslevel': 9 if level is None else level}
+        )
+        return
 
-    return pd.Index([
-        (seq, int(pos), alt)
-        for seq, pos, alt in ind.str.extract(r'^([^:]+)[:]p[.][a-zA-Z]{3}(\d+)([a-zA-Z]{3})$').itertuples(index=False)
-    ])
+    with BgzfWriter(out_file, 6 if level is None else level, threads) as raw_handle:
+        out_handle = io.TextIOWrapper(raw_handle, encoding='utf-8')
+        df.to_csv(out_handle, sep='\t', float_format=float_format)
+        # Flush the text, leaving the BGZF file to be finished (or discarded) on leaving the block
+        out_handle.detach()
 
 
-def main(args):
+def write_parquet(df: pd.DataFrame, out_file: Path, level=None, decimals=None):
+    """Write processed predictions as Parquet"""
 
-    args.output_dir.mkdir(parents=True, exist_ok=True)
+    if decimals is not None:
+        df = df.round(decimals)
+    df.to_parquet(out_file, compression='zstd', compression_level=level)
+
+
+def make_writer(writer='gzip', level=None, threads=4, decimals=None):
+    """Function writing processed predictions (a frame indexed by HGVS) to a file, for the given --writer"""
 
-    data_df = pd.concat([pd.read_csv(in_path) for in_path in args.source], ignore_index=True).drop_duplicates()
+    if writer == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            raise ValueError('--writer parquet needs pyarrow, e.g. conda install pyarrow')
+        return partial(write_parquet, level=level, decimals=decimals)
+    if writer not in WRITERS:
+        raise ValueError(f'Unknown writer {writer}; expected one of {list(WRITERS)}')
+    return partial(write_tsv, bgzf=writer == 'bgzf', level=level, threads=threads, decimals=decimals)
+
+
+def split_chunks(data_df: pd.DataFrame):
+    """Separate out transcript and range from the chunk ID, and convert segment positions to global positions"""
 
-    # Separate out transcript and range
     index_df = data_df.chunk.str.split(r'[][:]', n=4, expand=True, regex=True)
     index_df.columns = 'seq', 'start', 'end', 'blank'
-    
+
     working_df = pd.concat(
         [index_df.drop('blank', axis='columns'), data_df.drop('chunk', axis='columns')],
         axis='columns'
@@ -146,68 +455,259 @@ def main(args):
         'end': int,
         'pos': int
     })
-    # Convert segment positions to global positions
     working_df['pos'] = working_df['pos'] + working_df['start']
 
-    for seq, df in tqdm(working_df.groupby('seq')):
+    return working_df
 
-        out_file: Path = args.output_dir / f'{seq}.tsv.gz'
 
-        if args.overwrite or not out_file.exists():
+def read_npz_results(in_path: Path):
+    """Read predictions written by predict_substitutions.py with `--format npz`.
+
+    Yields one frame per chunk and model, in the same layout as the CSV
+    output (limited to the amino acid columns), with float32 scores.
+    """
+
+    with np.load(in_path) as archive:
+        columns = [str(aa) for aa in archive['columns']]
+        for name in archive.files:
+            if not name.startswith('scores/'):
+                continue
+            _, model, chunk = name.split('/', 2)
+            if model == ENSEMBLE_MEAN:
+                continue
+            ref = str(archive[f'ref/{chunk}'])
+            frame = pd.DataFrame(archive[name].astype(np.float32), columns=columns)
+            frame.insert(0, 'chunk', chunk)
+            frame.insert(1, 'pos', np.arange(len(ref), dtype=np.int32))
+            frame.insert(2, 'ref', list(ref))
+            frame['model'] = model
+            yield frame
+
+
+def read_source(in_path: Path):
+    """Read a raw predictions file (CSV or npz) into a frame."""
+
+    if in_path.suffix == '.npz':
+        return pd.concat(read_npz_results(in_path), ignore_index=True)
+    return pd.read_csv(in_path)
+
+
+def read_source_chunks(in_path: Path, chunk_rows):
+    """Iterate over a raw predictions file (CSV or npz) in pieces, using compact types."""
+
+    if in_path.suffix == '.npz':
+        return (
+            frame[list(STREAM_DTYPES)].astype({'ref': 'category', 'model': 'category'})
+            for frame in read_npz_results(in_path)
+        )
+
+    columns = pd.read_csv(in_path, nrows=0).columns
+    if 'alt' in columns:
+        # Ensemble output
+        dtypes = {
+            'chunk': str,
+            'pos': 'int32',
+            'ref': 'category',
+            'alt': 'category',
+            **{col: 'float32' for col in columns if col not in ID_COLS + ['chunk', ENSEMBLE_MEAN]}
+        }
+    else:
+        dtypes = STREAM_DTYPES
+    return pd.read_csv(in_path, usecols=list(dtypes), dtype=dtypes, chunksize=chunk_rows)
+
+
+def load_proteins(sources):
+    """Read all sources into memory and group them by protein."""
+
+    data_df = pd.concat([read_source(in_path) for in_path in sources], ignore_index=True).drop_duplicates()
+
+    return split_chunks(data_df).groupby('seq')
+
+
+def stream_proteins(sources, chunk_rows):
+    """Read sources in chunks and yield (seq, df) for each protein once it is complete.
+
+    Sources are read concurrently, chunk_rows rows (or one npz array) at a time. A protein is
+    complete (all of its windows and models are present) once every source has
+    either moved on to a later protein or has been read to the end.
+    """
+
+    readers = [read_source_chunks(in_path, chunk_rows) for in_path in sources]
+    # Proteins each source has moved past, and the one it is currently on
+    passed = [set() for _ in readers]
+    current = [None for _ in readers]
+    active = set(range(len(readers)))
+    pending = {}
+    emitted = set()
+
+    def ready(seq):
+        return all(i not in active or seq in passed[i] for i in range(len(readers)))
+
+    with ThreadPoolExecutor(max_workers=len(readers)) as executor:
+        while active:
+            chunks = {
+                i: future.result()
+                for i, future in [(i, executor.submit(next, readers[i], None)) for i in sorted(active)]
+            }
+
+            for i, chunk in chunks.items():
+                if chunk is None:
+                    active.discard(i)
+                    continue
+
+                chunk = split_chunks(chunk)
+                for seq, df in chunk.groupby('seq', sort=False):
+                    if seq in emitted:
+                        raise ValueError(
+                            f'{seq} reappeared in {sources[i]} after it was processed; '
+                            'sources must list proteins contiguously. Run without --stream.'
+                        )
+                    if seq != current[i]:
+                        if current[i] is not None:
+                            passed[i].add(current[i])
+                        current[i] = seq
+                    pending.setdefault(seq, []).append(df)
+
+            for i in range(len(readers)):
+                if i not in active and current[i] is not None:
+                    passed[i].add(current[i])
+                    current[i] = None
+
+            for seq in [seq for seq in pending if ready(seq)]:
+                emitted.add(seq)
+                df = pd.concat(pending.pop(seq), ignore_index=True).drop_duplicates()
+                # Model names become the output columns, as plain strings
+                yield seq, df.astype({'model': str}) if 'model' in df.columns else df
+
+
+def pack_protein(df: pd.DataFrame):
+    """Columns of a protein's predictions as numpy arrays, with strings as category codes and categories.
+
+    These pickle as flat buffers, so handing a protein to a worker process
+    costs about a copy rather than pickling every string in the frame.
+    """
+
+    columns = {}
+    for col in df.columns.drop('seq', errors='ignore'):
+        values = df[col]
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            categorical = pd.Categorical(values)
+            columns[col] = (categorical.codes, categorical.categories.to_numpy(dtype=str))
+        else:
+            columns[col] = values.to_numpy()
+    return columns
+
 
-            try:
-                # Predictions are in the shape of reference AA x alternate AA,
-                # end result should have one variant per row.
-                (
-                    df
-                    # Pivot longer on alt AAs:
-                    .melt(
-                        id_vars=['seq', 'start', 'end', 'pos', 'ref', 'model'],
-                        value_vars=list(AA_COLS),
-                        var_name='alt',
-                        value_name='score',
-                        ignore_index=True
-                    )
-                    # Compose HVGS string, i.e. {seq}:p.{ref}{pos}{alt}
-                    .assign(
-                        HGVS=lambda df: df.seq + ':p.' + df.ref.map(AA_NAMES) + (df.pos + 1).astype(str) + df.alt.map(AA_NAMES)
-                    )
-                    # Pivot wider on models
-                    .pivot(
-                        index=['HGVS', 'pos', 'start', 'end'],
-                        columns='model',
-                        values='score'
-                    )
-                    # Merge overlapping estimates
-                    .groupby('HGVS', group_keys=False).apply(merge_estimates)
-                    # Sort nicely, i.e.
-                    # by sequence ID, then position, then alternate AA
-                    .sort_index(key=hgvs_order)
-                    # Write output
-                    .to_csv(out_file, sep='\t')
-                )
-            except ValueError as e:
-                print(seq)
-                melted = (
-                    df
-                    # Pivot longer on alt AAs:
-                    .melt(
-                        id_vars=['seq', 'start', 'end', 'pos', 'ref', 'model'],
-                        value_vars=list(AA_COLS),
-                        var_name='alt',
-                        value_name='score',
-                        ignore_index=True
-                    )
-                    # Compose HVGS string, i.e. {seq}:p.{ref}{pos}{alt}
-                    .assign(
-                        HGVS=lambda df: df.seq + ':p.' + df.ref.map(AA_NAMES) + (df.pos + 1).astype(str) + df.alt.map(AA_NAMES)
-                    )
-                )
-                print(melted[melted[['HGVS', 'pos', 'start', 'end', 'model']].duplicated()])
-                raise
+def unpack_protein(columns):
+    """Frame of a protein's predictions from pack_protein"""
+
+    return pd.DataFrame({
+        col: pd.Categorical.from_codes(*values) if isinstance(values, tuple) else values
+        for col, values in columns.items()
+    })
+
+
+def process_packed(seq, columns, out_file: Path, write):
+    """Process a protein packed by pack_protein, in a worker process.
+
+    Returns the worker's process ID, the number of raw scores and the seconds taken, for throughput reporting.
+    """
+
+    start_time = default_timer()
+    df = unpack_protein(columns)
+    process_protein(seq, df, out_file, write)
+    scores = len(df) if 'alt' in df.columns else len(df) * len(ALTS)
+    return os.getpid(), scores, default_timer() - start_time
+
+
+def process_parallel(proteins, output_dir: Path, overwrite, workers, write, suffix='.tsv.gz'):
+    """Process proteins in a pool of worker processes, with at most two proteins per worker waiting at a time."""
+
+    stats = defaultdict(lambda: [0, 0, 0.0])  # Proteins, raw scores and seconds per worker
+    start_time = default_timer()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, tqdm() as progress:
+        pending = set()
+
+        def collect(return_when):
+            nonlocal pending
+            done, pending = wait(pending, return_when=return_when)
+            for future in done:
+                pid, scores, seconds = future.result()
+                worker_stats = stats[pid]
+                worker_stats[0] += 1
+                worker_stats[1] += scores
+                worker_stats[2] += seconds
+                progress.update()
+
+        for seq, df in proteins:
+            out_file: Path = output_dir / f'{seq}{suffix}'
+            if out_file.exists() and not overwrite:
+                continue
+            if len(pending) >= 2 * workers:
+                collect(FIRST_COMPLETED)
+            pending.add(executor.submit(process_packed, seq, pack_protein(df), out_file, write))
+        collect(ALL_COMPLETED)
+
+    elapsed = default_timer() - start_time
+    for i, (pid, (proteins_done, scores, seconds)) in enumerate(sorted(stats.items())):
+        print(
+            f'Worker {i} (pid {pid}): {proteins_done} proteins, {scores} scores in {seconds:.1f} s busy '
+            f'({proteins_done / seconds:.2f} proteins/s, {scores / seconds:.0f} scores/s)'
+        )
+    total = sum(proteins_done for proteins_done, _, _ in stats.values())
+    print(f'{total} proteins in {elapsed:.1f} s with {workers} workers ({total / max(elapsed, 1e-9):.2f} proteins/s)')
+
+
+def process_protein(seq, df: pd.DataFrame, out_file: Path, write=write_tsv):
+    """Stitch, reshape and write the predictions for a single protein, with write from make_writer."""
+
+    try:
+        (
+            pivot_models(df)
+            # Merge overlapping estimates, sorted by position, then alternate AA
+            .pipe(stitch_windows)
+            .pipe(lambda stitched: label_variants(seq, stitched))
+            # Write output
+            .pipe(write, out_file)
+        )
+    except ValueError as e:
+        print(seq)
+        if 'alt' in df.columns:
+            melted = df.assign(alt=aa_codes(df['alt']), ref=aa_codes(df['ref']))
+            keys = VARIANT_KEYS + ['start', 'end']
+        else:
+            melted = melt_alts(df)
+            keys = VARIANT_KEYS + ['start', 'end', 'model']
+        duplicates = melted[melted[keys].duplicated()]
+        print(duplicates.assign(HGVS=compose_hgvs(seq, duplicates['pos'], duplicates['ref'], duplicates['alt'])))
+        raise
+
+
+def main(args):
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    write = make_writer(args.writer, args.compression_level, args.compression_threads, args.decimals)
+    suffix = WRITERS[args.writer]
+
+    if args.stream:
+        proteins = stream_proteins(args.source, args.chunk_rows)
+    else:
+        proteins = load_proteins(args.source)
+
+    if args.workers > 1:
+        process_parallel(proteins, args.output_dir, args.overwrite, args.workers, write, suffix)
+        return
+
+    for seq, df in tqdm(proteins):
+
+        out_file: Path = args.output_dir / f'{seq}{suffix}'
+
+        if args.overwrite or not out_file.exists():
+            process_protein(seq, df, out_file, write)
 
 
 if __name__ == '__main__':
     parser = create_parser()
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
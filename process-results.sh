@@ -4,4 +4,6 @@
 /ua/yuriy/mambaforge/envs/esm-1v-processing/bin/python process-results.py \
     --source chtc/proteins/missing-mane/missing-mane/bundle_${1}_m*.csv \
     --output-dir results/processed-mane \
-    --overwrite
\ No newline at end of file
+    --stream \
+    --workers 4 \
+    --overwrite
@@ -0,0 +1,179 @@
+"""
+Summarize the metrics of prediction jobs over a run directory.
+
+predict_substitutions.py and predict.py record metrics to a JSON-lines file
+with --metrics (the chtc submit files bring `{result}.metrics.jsonl` back with
+the results; see container/metrics.py for the records). This prints:
+* One row per job attempt: host, status, wall time, positions scored and
+  positions per second, padding fraction, batches split after running out of
+  memory, and peak memory. A job that was
+  evicted and resumed appends another attempt to the same file; attempts
+  without a summary were cut short, and are summarized from their batches.
+* The share of time spent in each stage, over all attempts.
+* Outlier proteins: those that took much longer per position than the median
+  protein scored with the same strategy. Batch time is attributed to the
+  proteins in a batch by their share of its positions.
+"""
+
+from pathlib import Path
+from collections import defaultdict
+import json
+import re
+
+import pandas as pd
+
+CHUNK_ID = re.compile(r'(.+)\[\d+:\d+\]')
+
+
+def create_parser():
+    """Command line argument parser. This also serves as a reference."""
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser('Summarize the metrics of prediction jobs')
+    parser.add_argument(
+        '--run-dir',
+        type=Path,
+        nargs='+',
+        help='Directories with metrics files (*.metrics.jsonl), or metrics files themselves.'
+    )
+    parser.add_argument(
+        '--outlier-ratio',
+        type=float,
+        default=3.0,
+        help='Report proteins that took at least this many times the median seconds per position.'
+    )
+    parser.add_argument('--outliers', type=int, default=20, help='Maximum number of outlier proteins to report.')
+    parser.add_argument('--proteins', type=Path, help='TSV file to write the time attributed to every protein to.')
+    return parser
+
+
+def read_attempts(path):
+    """Split the records of a metrics file into job attempts, each a list of records starting with a job record"""
+
+    attempts = []
+    with path.open('rt') as in_handle:
+        for line in in_handle:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written line of a job that was cut short
+                continue
+            if record['event'] == 'job' or not attempts:
+                attempts.append([])
+            attempts[-1].append(record)
+    return attempts
+
+
+def summarize_attempt(path, attempt_number, records):
+    """A row for the jobs table, and the stage times and batches of an attempt"""
+
+    job = records[0] if records[0]['event'] == 'job' else {}
+    batches = [record for record in records if record['event'] == 'batch']
+    summary = next((record for record in records if record['event'] == 'summary'), None)
+
+    if summary is not None:
+        wall_seconds = summary['wall_seconds']
+        positions = summary['counters'].get('positions', 0)
+        padding_fraction = summary['padding_fraction']
+        stages = summary['stages']
+        status = summary.get('status', 'completed')
+    else:
+        wall_seconds = records[-1]['time'] - records[0]['time']
+        positions = sum(batch['positions'] for batch in batches)
+        padded_tokens = sum(batch['padded_tokens'] for batch in batches)
+        real_tokens = sum(batch['real_tokens'] for batch in batches)
+        padding_fraction = 1 - real_tokens / padded_tokens if padded_tokens else None
+        stages = {}
+        status = 'cut short'
+
+    row = {
+        'file': path.name,
+        'attempt': attempt_number,
+        'host': job.get('host'),
+        'status': status,
+        'wall_seconds': wall_seconds,
+        'model_load_seconds': sum(record['seconds'] for record in records if record['event'] == 'model_load'),
+        'batches': len(batches),
+        'oom_splits': sum(record['event'] == 'oom' for record in records),
+        'positions': positions,
+        'positions_per_second': positions / wall_seconds if wall_seconds else None,
+        'padding_fraction': padding_fraction,
+        'peak_rss_mb': summary and summary.get('peak_rss_mb'),
+        'peak_gpu_mb': summary and summary.get('peak_gpu_allocated_mb')
+    }
+    return row, stages, batches
+
+
+def attribute_batches(batches):
+    """Frame of seconds and positions per protein and strategy, attributing batch time by positions"""
+
+    seconds = defaultdict(float)
+    positions = defaultdict(int)
+    for batch in batches:
+        chunks = batch.get('chunks')
+        if not chunks:
+            continue
+        batch_positions = sum(chunk_positions for _, chunk_positions in chunks)
+        for chunk_id, chunk_positions in chunks:
+            match = CHUNK_ID.fullmatch(chunk_id)
+            key = (match[1] if match else chunk_id, batch['strategy'])
+            seconds[key] += batch['seconds'] * chunk_positions / batch_positions
+            positions[key] += chunk_positions
+
+    proteins = pd.DataFrame(
+        [(*key, seconds[key], positions[key]) for key in seconds],
+        columns=['seq', 'strategy', 'seconds', 'positions']
+    )
+    proteins['seconds_per_position'] = proteins['seconds'] / proteins['positions']
+    proteins['ratio_to_median'] = proteins['seconds_per_position'] / proteins.groupby('strategy')[
+        'seconds_per_position'
+    ].transform('median')
+    return proteins
+
+
+def main(args):
+
+    paths = []
+    for path in args.run_dir:
+        paths.extend(sorted(path.glob('*.metrics.jsonl')) if path.is_dir() else [path])
+    if not paths:
+        raise ValueError(f'No metrics files in {args.run_dir}')
+
+    rows = []
+    stages = defaultdict(float)
+    batches = []
+    for path in paths:
+        for attempt_number, records in enumerate(read_attempts(path), 1):
+            row, attempt_stages, attempt_batches = summarize_attempt(path, attempt_number, records)
+            rows.append(row)
+            for name, seconds in attempt_stages.items():
+                stages[name] += seconds
+            batches.extend(attempt_batches)
+
+    jobs = pd.DataFrame(rows)
+    print(f'{len(paths)} metrics files, {len(jobs)} job attempts ({(jobs["status"] != "completed").sum()} not completed)')
+    print(jobs.to_string(index=False, float_format='{:.3g}'.format))
+    print(
+        f'\nTotal: {jobs["wall_seconds"].sum() / 3600:.3g} hours, {jobs["positions"].sum()} positions, '
+        f'{jobs["positions"].sum() / jobs["wall_seconds"].sum():.3g} positions/second'
+    )
+
+    if stages:
+        stage_table = pd.Series(stages, name='seconds').sort_values(ascending=False).to_frame()
+        stage_table['share'] = stage_table['seconds'] / stage_table['seconds'].sum()
+        print('\nTime per stage (exclusive, summed over threads):')
+        print(stage_table.to_string(float_format='{:.3g}'.format))
+
+    proteins = attribute_batches(batches)
+    if args.proteins:
+        proteins.sort_values('seconds', ascending=False).to_csv(args.proteins, sep='\t', index=False)
+    outliers = proteins[proteins['ratio_to_median'] >= args.outlier_ratio].nlargest(args.outliers, 'seconds')
+    print(f'\n{(proteins["ratio_to_median"] >= args.outlier_ratio).sum()} of {len(proteins)} proteins took at least {args.outlier_ratio}x the median time per position:')
+    if len(outliers):
+        print(outliers.to_string(index=False, float_format='{:.3g}'.format))
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args()
+    main(args)
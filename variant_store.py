@@ -0,0 +1,300 @@
+"""
+Indexed store of processed predictions, for random access to any variant.
+
+Consolidates a directory of process-results.py outputs (one `{seq}.tsv.gz` or
+`{seq}.parquet` per protein) into a single store directory holding:
+
+* `scores.bin`: A float32 array of shape (positions, alternate AAs, score columns),
+  with the positions of all proteins one after the other. Variants that a
+  processed file has no score for (e.g. `{model}_next` outside window overlaps)
+  are NaN.
+* `proteins.tsv`: The index: sequence ID, offset of its first position in
+  `scores.bin`, length, and sequence.
+* `meta.json`: The shape of the array, the alternate AAs and the score columns.
+
+The array is memory-mapped, so a query only reads the positions it asks for.
+
+Build a store with
+```
+python variant_store.py build --processed-dir results/processed-mane --store results/mane-store
+```
+and query it with `python variant_store.py query` (see create_parser), or from
+Python with VariantStore.
+"""
+
+from pathlib import Path
+import json
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+AA_COLS = 'LAGVSERTIDPKQNFYMHWCUO' # Should match process-results.py
+AA_NAMES = {
+    'A': 'Ala',
+    'R': 'Arg',
+    'N': 'Asn',
+    'D': 'Asp',
+    'C': 'Cys',
+    'Q': 'Gln',
+    'E': 'Glu',
+    'G': 'Gly',
+    'H': 'His',
+    'I': 'Ile',
+    'L': 'Leu',
+    'K': 'Lys',
+    'M': 'Met',
+    'F': 'Phe',
+    'P': 'Pro',
+    'S': 'Ser',
+    'T': 'Thr',
+    'W': 'Trp',
+    'Y': 'Tyr',
+    'V': 'Val',
+    'U': 'Sec',
+    'O': 'Pyl'
+}
+# process-results.py names reference AAs outside AA_COLS (e.g. X, B, Z) Xaa
+AA_CODES = {**{name: aa for aa, name in AA_NAMES.items()}, 'Xaa': 'X'}
+# Alternate AAs in the order of processed outputs (by three letter code, see ALTS in process-results.py)
+ALTS = ''.join(sorted(AA_COLS, key=AA_NAMES.get))
+HGVS_PATTERN = r'^([^:]+):p\.([A-Z][a-z]{2})(\d+)([A-Z][a-z]{2})$'
+HGVS_REGEX = re.compile(HGVS_PATTERN)
+# Suffixes of the processed outputs of process-results.py (see its --writer)
+PROCESSED_SUFFIXES = ('.tsv.gz', '.parquet')
+
+
+def create_parser():
+    """Command line argument parser. This also serves as a reference."""
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser('Build or query an indexed store of processed predictions')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Build a store from processed predictions')
+    build.add_argument(
+        '--processed-dir',
+        type=Path,
+        nargs='+',
+        help='Directories of processed outputs ({sequence ID}.tsv.gz or .parquet) from process-results.py.'
+    )
+    build.add_argument('--store', type=Path, help='Directory to write the store to.')
+
+    query = subparsers.add_parser('query', help='Look up variants, written to standard output as TSV')
+    query.add_argument('--store', type=Path)
+    query.add_argument('--hgvs', type=str, nargs='+', help='HGVS IDs of variants, e.g. ENSP00000000233.5:p.Met1Ala')
+    query.add_argument('--hgvs-file', type=Path, help='File with one HGVS ID per line, for batch lookups.')
+    query.add_argument('--protein', type=str, help='Sequence ID, to list all variants of a protein (or a range).')
+    query.add_argument('--start', type=int, help='First (1-based) position of the range with --protein.')
+    query.add_argument('--end', type=int, help='Last (1-based) position of the range with --protein.')
+    return parser
+
+
+def parse_hgvs(hgvs: pd.Series):
+    """Frame of sequence ID, (1-based) position, reference and alternate AA of HGVS IDs; NaN where they don't parse."""
+
+    parts = hgvs.str.extract(HGVS_PATTERN)
+    parts.columns = ['seq', 'ref', 'pos', 'alt']
+    parts['pos'] = pd.to_numeric(parts['pos'])
+    parts['ref'] = parts['ref'].map(AA_CODES)
+    parts['alt'] = parts['alt'].map(AA_CODES)
+    return parts
+
+
+def read_processed(path: Path, columns_only=False):
+    """A processed output, indexed by HGVS; only its (empty) header with columns_only"""
+
+    if path.name.endswith('.parquet'):
+        if columns_only:
+            import pyarrow.parquet as pq
+            names = pq.read_schema(path).names
+            return pd.DataFrame(columns=[name for name in names if name != 'HGVS'])
+        return pd.read_parquet(path)
+    return pd.read_csv(path, sep='\t', index_col='HGVS', nrows=0 if columns_only else None)
+
+
+def build(processed_dirs, store: Path):
+    """Consolidate processed outputs into a store."""
+
+    paths = sorted(
+        path for directory in processed_dirs for suffix in PROCESSED_SUFFIXES for path in directory.glob(f'*{suffix}')
+    )
+    if not paths:
+        raise ValueError(f'No processed outputs in {processed_dirs}')
+
+    # Score columns of all outputs, in order of appearance (not every output has the {model}_next columns)
+    columns = {}
+    for path in paths:
+        try:
+            columns.update(dict.fromkeys(read_processed(path, columns_only=True).columns))
+        except (OSError, EOFError, ValueError):
+            pass
+    columns = list(columns)
+
+    store.mkdir(parents=True, exist_ok=True)
+    offset = 0
+    index = []
+    alt_index = {aa: i for i, aa in enumerate(ALTS)}
+
+    with (store / 'scores.bin').open('wb') as out_handle:
+        for path in tqdm(paths):
+            seq = next(path.name[:-len(suffix)] for suffix in PROCESSED_SUFFIXES if path.name.endswith(suffix))
+            try:
+                df = read_processed(path)
+            except (OSError, EOFError, ValueError):
+                print(f'{path} is truncated or not a valid gzip or Parquet file, skipping it')
+                continue
+            df = df.reindex(columns=columns)
+
+            parts = parse_hgvs(df.index.to_series())
+            alts = parts['alt'].map(alt_index)
+            unexpected = parts[['seq', 'pos', 'ref']].isna().any(axis='columns') | alts.isna() | (parts['seq'] != seq)
+            if unexpected.any() or df.empty:
+                print(f'{path} has no scores or unexpected HGVS IDs, skipping it')
+                continue
+            positions = parts['pos'].to_numpy() - 1
+            length = int(positions.max()) + 1
+
+            scores = np.full((length, len(ALTS), len(columns)), np.nan, dtype=np.float32)
+            scores[positions, alts.to_numpy()] = df.to_numpy(dtype=np.float32)
+            scores.tofile(out_handle)
+
+            sequence = np.full(length, 'X')
+            sequence[positions] = parts['ref'].to_numpy()
+            index.append((seq, offset, length, ''.join(sequence)))
+            offset += length
+
+    pd.DataFrame(index, columns=['seq', 'offset', 'length', 'sequence']).to_csv(
+        store / 'proteins.tsv', sep='\t', index=False
+    )
+    (store / 'meta.json').write_text(json.dumps({
+        'shape': [offset, len(ALTS), len(columns)],
+        'alts': ALTS,
+        'columns': columns
+    }))
+    print(f'Stored {len(index)} proteins, {offset} positions in {store}')
+
+
+class VariantStore:
+    """Random access to a store built with `variant_store.py build`.
+
+    Lookups return frames indexed by HGVS with the score columns of the
+    processed outputs, like the processed files themselves.
+    """
+
+    def __init__(self, path):
+        path = Path(path)
+        meta = json.loads((path / 'meta.json').read_text())
+        self.alts = meta['alts']
+        self.columns = meta['columns']
+        self.scores = np.memmap(path / 'scores.bin', dtype=np.float32, mode='r', shape=tuple(meta['shape']))
+        self.proteins = pd.read_csv(path / 'proteins.tsv', sep='\t', index_col='seq')
+        self._offsets = self.proteins['offset'].to_dict()
+        self._lengths = self.proteins['length'].to_dict()
+        self._alt_index = {aa: i for i, aa in enumerate(self.alts)}
+        self._sequences = self.proteins['sequence'].to_dict()
+
+    def __contains__(self, seq):
+        return seq in self._offsets
+
+    def sequence(self, seq):
+        return self._sequences[seq]
+
+    def _frame(self, seq, positions, alts, scores):
+        """Frame of scores for variants at (0-based) positions of seq to alts"""
+
+        sequence = self.sequence(seq)
+        hgvs = [
+            f'{seq}:p.{AA_NAMES.get(sequence[pos], "Xaa")}{pos + 1}{AA_NAMES[alt]}'
+            for pos, alt in zip(positions, alts)
+        ]
+        return pd.DataFrame(scores, index=pd.Index(hgvs, name='HGVS'), columns=self.columns)
+
+    def range(self, seq, start=None, end=None):
+        """All variants at (1-based, inclusive) positions start to end of seq, or all of seq"""
+
+        if seq not in self:
+            raise KeyError(f'{seq} is not in the store')
+        start = max(start or 1, 1)
+        end = min(end or self._lengths[seq], self._lengths[seq])
+        offset = self._offsets[seq]
+        scores = self.scores[offset + start - 1:offset + end]
+        positions = np.repeat(np.arange(start - 1, end), len(self.alts))
+        alts = list(self.alts) * (end - start + 1)
+        return self._frame(seq, positions, alts, scores.reshape(-1, len(self.columns)))
+
+    def protein(self, seq):
+        return self.range(seq)
+
+    def lookup(self, hgvs):
+        """Scores of a single variant, as an array in the order of the columns attribute.
+
+        Raises KeyError for variants that are not in the store.
+        """
+
+        match = HGVS_REGEX.match(hgvs)
+        if match is None:
+            raise KeyError(f'{hgvs} is not an HGVS ID of a substitution')
+        seq, ref, pos, alt = match.groups()
+        pos = int(pos)
+        if seq not in self or not 1 <= pos <= self._lengths[seq] or AA_CODES.get(alt) not in self._alt_index:
+            raise KeyError(f'{hgvs} is not in the store')
+        if self.sequence(seq)[pos - 1] != AA_CODES.get(ref):
+            raise KeyError(f'{hgvs} does not match the reference sequence {seq} in the store')
+        return np.array(self.scores[self._offsets[seq] + pos - 1, self._alt_index[AA_CODES[alt]]])
+
+    def lookup_many(self, hgvs):
+        """Scores of many variants at once, in the order given.
+
+        Variants of proteins not in the store, beyond their ends, or with a
+        reference AA that does not match the stored sequence get NaN scores.
+        """
+
+        hgvs = pd.Series(list(hgvs), dtype=str)
+        parts = parse_hgvs(hgvs)
+        offsets = parts['seq'].map(self._offsets)
+        lengths = parts['seq'].map(self._lengths)
+        alt_indices = parts['alt'].map(self._alt_index)
+        valid = (
+            offsets.notna() & alt_indices.notna() & parts['pos'].between(1, lengths)
+        ).to_numpy()
+
+        rows = (offsets[valid] + parts['pos'][valid] - 1).astype(np.int64).to_numpy()
+        stored_refs = np.array([
+            self.sequence(seq)[pos - 1] for seq, pos in zip(parts['seq'][valid], parts['pos'][valid].astype(int))
+        ], dtype=object)
+        matched = stored_refs == parts['ref'][valid].to_numpy()
+
+        result = np.full((len(hgvs), len(self.columns)), np.nan, dtype=np.float32)
+        result[np.flatnonzero(valid)[matched]] = self.scores[
+            rows[matched], alt_indices[valid].astype(np.int64).to_numpy()[matched]
+        ]
+        return pd.DataFrame(result, index=pd.Index(hgvs, name='HGVS'), columns=self.columns)
+
+
+def main(args):
+
+    if args.command == 'build':
+        build(args.processed_dir, args.store)
+        return
+
+    store = VariantStore(args.store)
+    frames = []
+    if args.protein:
+        frames.append(store.range(args.protein, args.start, args.end))
+    hgvs = list(args.hgvs or [])
+    if args.hgvs_file:
+        hgvs += [line.strip() for line in args.hgvs_file.open('rt') if line.strip()]
+    if hgvs:
+        frames.append(store.lookup_many(hgvs))
+    if not frames:
+        raise ValueError('Nothing to query; give --hgvs, --hgvs-file or --protein')
+    pd.concat(frames).to_csv(sys.stdout, sep='\t')
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args()
+    main(args)